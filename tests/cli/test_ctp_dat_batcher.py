@@ -7,11 +7,24 @@
 """Define tests for the ctp_dat_batcher CLI script."""
 
 import os
+import pydicom
 import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
 from unittest.mock import patch, MagicMock
 from pathlib import Path
 from tml_ctp.info import __container_name__, __version__
-from tml_ctp.cli.ctp_dat_batcher import update_dat_script_file, check_and_rename_dicom_files, get_patient_identifiers
+from tml_ctp.cli.ctp_dat_batcher import (
+    update_dat_script_file,
+    check_and_rename_dicom_files,
+    get_patient_identifiers,
+    create_docker_pool_command,
+    create_docker_exec_command,
+    DAT_CONTAINER_LABEL,
+    DatContainerPool,
+    get_inputs_root,
+    rename_ctp_output_subject_folders,
+)
 
 
 @pytest.fixture
@@ -187,3 +200,155 @@ def test_get_patient_identifiers(mock_dcmread, mock_os_walk):
     result = get_patient_identifiers(dicom_folder)
 
     assert result == {"JohnDoe", "JaneSmith"}
+
+
+def test_create_docker_pool_command(tmp_path):
+    """Test that create_docker_pool_command mounts the common parent of the patient folders once."""
+    input_folders = tmp_path / "inputs"
+    (input_folders / "sub-01").mkdir(parents=True)
+    (input_folders / "sub-02").mkdir(parents=True)
+
+    cmd = create_docker_pool_command(
+        input_folders=str(input_folders),
+        patient_folders=["sub-01", "sub-02"],
+        output_folder=str(tmp_path / "outputs"),
+        script_dir=str(tmp_path / "scripts"),
+        image_tag="tml-ctp-anonymizer:test",
+    )
+
+    assert cmd[:6] == ["docker", "run", "-d", "--rm", "--label", DAT_CONTAINER_LABEL]
+    mounts = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-v"]
+    assert mounts == [
+        f"{os.path.realpath(input_folders)}:/inputs:ro",
+        f"{tmp_path / 'outputs'}:/outputs",
+        f"{tmp_path / 'scripts'}:/scripts:ro",
+    ]
+    assert cmd[-4:] == ["--entrypoint", "sleep", "tml-ctp-anonymizer:test", "infinity"]
+
+
+def test_get_inputs_root(tmp_path):
+    """Test that get_inputs_root includes the patient folders linking outside of the input folders."""
+    input_folders = tmp_path / "inputs"
+    (input_folders / "sub-01").mkdir(parents=True)
+    assert get_inputs_root(str(input_folders), ["sub-01"]) == os.path.realpath(input_folders)
+
+    # Patient folder linking to a folder outside of the input folders
+    (tmp_path / "elsewhere" / "sub-02").mkdir(parents=True)
+    (input_folders / "sub-02").symlink_to(tmp_path / "elsewhere" / "sub-02")
+    assert get_inputs_root(
+        str(input_folders), ["sub-01", "sub-02"]
+    ) == os.path.realpath(tmp_path)
+
+
+def test_create_docker_exec_command():
+    """Test that create_docker_exec_command addresses the folders and script as mounted in the container."""
+    cmd = create_docker_exec_command(
+        container_id="abc123",
+        rel_input="sub-01",
+        rel_output="sub-01",
+        rel_script="sub-01.script",
+    )
+
+    assert cmd == [
+        "docker",
+        "exec",
+        "abc123",
+        "/app/entrypoint_anonymizer.sh",
+        "-in",
+        "/inputs/sub-01",
+        "-out",
+        "/outputs/sub-01",
+        "-da",
+        "/scripts/sub-01.script",
+    ]
+
+
+@patch("tml_ctp.cli.ctp_dat_batcher.subprocess.run")
+def test_dat_container_pool(mock_run):
+    """Test that DatContainerPool starts `size` containers, assigns them round-robin and removes them on exit."""
+    mock_run.side_effect = [
+        MagicMock(returncode=0, stdout="container1\n"),
+        MagicMock(returncode=0, stdout="container2\n"),
+        MagicMock(returncode=0),
+        MagicMock(returncode=0),
+    ]
+
+    with DatContainerPool(
+        "/fake/inputs",
+        ["sub-01", "sub-02", "sub-03"],
+        "/fake/outputs",
+        "/fake/scripts",
+        size=2,
+    ) as pool:
+        assert pool.container_ids == ["container1", "container2"]
+        assert [pool.get_container_id(i) for i in range(3)] == [
+            "container1",
+            "container2",
+            "container1",
+        ]
+        # Both containers are started with the same command
+        assert mock_run.call_args_list[0] == mock_run.call_args_list[1]
+        assert mock_run.call_args_list[0].args[0][:2] == ["docker", "run"]
+
+    assert pool.container_ids == []
+    assert mock_run.call_args_list[2].args[0] == ["docker", "rm", "-f", "container1"]
+    assert mock_run.call_args_list[3].args[0] == ["docker", "rm", "-f", "container2"]
+
+
+@patch("tml_ctp.cli.ctp_dat_batcher.subprocess.run")
+def test_dat_container_pool_start_failure(mock_run):
+    """Test that DatContainerPool removes the containers already started when a container fails to start."""
+    mock_run.side_effect = [
+        MagicMock(returncode=0, stdout="container1\n"),
+        MagicMock(returncode=125, stdout="", stderr="no such image"),
+        MagicMock(returncode=0),
+    ]
+
+    pool = DatContainerPool(
+        "/fake/inputs", ["sub-01", "sub-02"], "/fake/outputs", "/fake/scripts", size=2
+    )
+    with pytest.raises(Exception, match="no such image"):
+        pool.start()
+
+    assert pool.container_ids == []
+    assert mock_run.call_args_list[-1].args[0] == ["docker", "rm", "-f", "container1"]
+
+
+def test_rename_ctp_output_subject_folders_extensionless(tmp_path):
+    """Test that series with extensionless DICOM files and non-DICOM files are renamed."""
+    series_dir = tmp_path / "sub-01" / "ses-01" / "series"
+    series_dir.mkdir(parents=True)
+    # Must be skipped if listed before the DICOM file as it is not a DICOM file
+    (series_dir / "a_notes.txt").write_text("not a DICOM file")
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.PatientID = "ABC123"
+    ds.StudyDate = "20200101"
+    ds.StudyTime = "120000.000"
+    ds.SeriesNumber = 3
+    ds.SeriesDescription = "T1w"
+    ds.save_as(str(series_dir / "IM0001"), write_like_original=False)
+
+    rename_ctp_output_subject_folders(str(tmp_path), "sub-01")
+
+    new_series_dir = tmp_path / "sub-ABC123" / "ses-20200101120000" / "3_T1w"
+    assert (new_series_dir / "IM0001").is_file()
+    assert (new_series_dir / "a_notes.txt").is_file()
+    assert not (tmp_path / "sub-01").exists()
+
+
+def test_rename_ctp_output_subject_folders_leftovers(tmp_path):
+    """Test that the original subject folder is removed even if some files could not be moved."""
+    series_dir = tmp_path / "sub-01" / "ses-01" / "series"
+    series_dir.mkdir(parents=True)
+    # Series without any DICOM file, which cannot be renamed
+    (series_dir / "notes.txt").write_text("not a DICOM file")
+    (tmp_path / "sub-01" / "stray.txt").write_text("stray file")
+
+    rename_ctp_output_subject_folders(str(tmp_path), "sub-01")
+
+    assert not (tmp_path / "sub-01").exists()
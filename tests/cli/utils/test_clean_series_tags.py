@@ -8,45 +8,52 @@
 
 import os
 import shutil
-import glob
 import pydicom
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.valuerep import PersonName
+
+from tml_ctp.cli.utils.clean_series_tags import anonymize_tags
+from tests.utils import clone_cohort, dcm_at_depth
+
+
+def _verify_cleaned(dicom_file):
+    """Check that PACSMAN1 does not appear anymore in the identifying tags of a DICOM file."""
+    ds = pydicom.dcmread(
+        dicom_file,
+        specific_tags=[
+            "PatientName",
+            "PatientID",
+            "SourcePatientGroupIdentificationSequence",
+        ],
+        stop_before_pixels=True,
+    )
+    assert ds.PatientName != "PACSMAN1"
+    assert ds.PatientID != "PACSMAN1"
+    assert ds.SourcePatientGroupIdentificationSequence[0].PatientID != "PACSMAN1"
 
 
-def test_clean_series_tags_script_basic(script_runner, test_dir, data_dir):
+def test_clean_series_tags_script_basic(
+    script_runner, test_dir, data_dir, cohort_with_seriesdate
+):
 
+    # Clone the datasets with SeriesDate already injected to a temporary folder
     test_dataset = "PACSMANCohort-clean_series_tags"
-    # Copy the dataset to a temporary folder
-    shutil.copytree(
-        os.path.join(data_dir, "PACSMANCohort"),
+    clone_cohort(
+        cohort_with_seriesdate(os.path.join(data_dir, "PACSMANCohort"), "20230101"),
         os.path.join(test_dir, "tmp", test_dataset),
     )
 
     test_ctp_dataset = "PACSMANCohort-CTP-clean_series_tags"
-    # Copy the dataset to a temporary folder
-    shutil.copytree(
-        os.path.join(test_dir, "tmp", "PACSMANCohort-CTP-basic"),
+    clone_cohort(
+        cohort_with_seriesdate(
+            os.path.join(test_dir, "tmp", "PACSMANCohort-CTP-basic"), "20231008"
+        ),
         os.path.join(test_dir, "tmp", test_ctp_dataset),
     )
 
-    # Add SeriesDate to all dicom files in the test_dataset
-    dicom_files = glob.glob(
-        os.path.join(test_dir, "tmp", test_dataset, "*", "*", "*", "*.dcm")
-    )
-    for dicom_file in dicom_files:
-        ds = pydicom.dcmread(dicom_file)
-        ds.SeriesDate = "20230101"
-        ds.save_as(dicom_file)
-
-    # Add SeriesDate to all dicom files in the test_ctp_dataset
-    dicom_files = glob.glob(
-        os.path.join(test_dir, "tmp", test_ctp_dataset, "*", "*", "*", "*.dcm")
-    )
-    for dicom_file in dicom_files:
-        ds = pydicom.dcmread(dicom_file)
-        ds.SeriesDate = "20231008"
-        ds.save_as(dicom_file)
-
     # Run the clean_series_tags script
     cmd = [
         "tml_ctp_clean_series_tags",
@@ -71,14 +78,10 @@ def test_clean_series_tags_script_basic(script_runner, test_dir, data_dir):
 
     # Check that the dicom files have been cleaned from any PatientID, PatientName
     # Original PatientID/PatientName : PACSMAN1
-    dicom_files = glob.glob(
-        os.path.join(test_dir, "tmp", test_ctp_dataset, "*", "*", "*", "*.dcm")
-    )
-    for dicom_file in dicom_files:
-        ds = pydicom.dcmread(dicom_file)
-        assert ds.PatientName != "PACSMAN1"
-        assert ds.PatientID != "PACSMAN1"
-        assert ds.SourcePatientGroupIdentificationSequence[0].PatientID != "PACSMAN1"
+    dicom_files = dcm_at_depth(os.path.join(test_dir, "tmp", test_ctp_dataset))
+    with ThreadPoolExecutor() as executor:
+        # Consume the iterator so that any failing assertion is raised here
+        list(executor.map(_verify_cleaned, dicom_files))
 
 
 def test_clean_series_tags_script_basic_noseriesdate(script_runner, test_dir, data_dir):
@@ -133,3 +136,57 @@ def test_clean_series_tags_script_basic_noseriesdate(script_runner, test_dir, da
         """['original_ref_image.SeriesDate', 'ctp_ref_image.SeriesDate']"""
         in content.strip()
     )
+
+
+def test_anonymize_tags_person_name():
+    ds = Dataset()
+    ds.PatientName = "PACSMAN1^Jane"
+
+    ds, changed = anonymize_tags(ds, [["PACSMAN1", "sub-1234"]])
+
+    assert changed
+    assert isinstance(ds.PatientName, PersonName)
+    assert str(ds.PatientName) == "sub-1234^Jane"
+
+
+def test_anonymize_tags_multivalue():
+    ds = Dataset()
+    ds.OtherPatientIDs = ["PACSMAN1", "OTHER", "PACSMAN1-2"]
+    ds.ReferencedFrameNumber = [20230101, 3]
+
+    ds, changed = anonymize_tags(
+        ds, [["PACSMAN1", "sub-1234"], ["20230101", "20231008"]]
+    )
+
+    assert changed
+    assert list(ds.OtherPatientIDs) == ["sub-1234", "OTHER", "sub-1234-2"]
+    assert list(ds.ReferencedFrameNumber) == [20231008, 3]
+
+
+def test_anonymize_tags_nested_sequence():
+    item = Dataset()
+    item.PatientID = "PACSMAN1"
+    ds = Dataset()
+    ds.PatientID = "OTHER"
+    ds.SourcePatientGroupIdentificationSequence = Sequence([item])
+
+    ds, changed = anonymize_tags(ds, [["PACSMAN1", "sub-1234"]])
+
+    assert changed
+    assert ds.PatientID == "OTHER"
+    assert ds.SourcePatientGroupIdentificationSequence[0].PatientID == "sub-1234"
+
+
+def test_anonymize_tags_unchanged():
+    ds = Dataset()
+    ds.PatientID = "OTHER"
+    ds.SeriesDate = "20230101"
+
+    # Pairs with identical or empty strings are ignored
+    ds, changed = anonymize_tags(
+        ds, [["PACSMAN1", "sub-1234"], ["20230101", "20230101"], ["", "x"]]
+    )
+
+    assert not changed
+    assert ds.PatientID == "OTHER"
+    assert ds.SeriesDate == "20230101"
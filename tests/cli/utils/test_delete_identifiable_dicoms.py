@@ -7,29 +7,33 @@
 """Define tests for the clean_series_tags CLI script."""
 
 import os
-import shutil
-import glob
-import pydicom
-import pandas as pd
+import pytest
 
+from tml_ctp.cli.utils.delete_identifiable_dicoms import delete_identifiable_dicom_series
+from tests.utils import clone_cohort, dcm_at_depth, write_dicom
 
-def test_delete_identifiable_dicoms_script_basic(script_runner, test_dir, data_dir):
 
-    test_dataset = "PACSMANCohort-delete_identifiable_dicoms"
-    # Copy the dataset to a temporary folder
-    shutil.copytree(
-        os.path.join(data_dir, "PACSMANCohort"),
-        os.path.join(test_dir, "tmp", test_dataset),
-    )
+# Series-level header elements flagging a whole series as identifiable
+IDENTIFIABLE_SERIES_ELEMENTS = [
+    {"Modality": "MR", "SeriesDescription": "DEV report"},
+    {"Modality": "MR", "ProtocolName": "AAHead_Scout"},
+    {"Modality": "SR"},
+]
+
+
+@pytest.mark.parametrize(
+    "extra_args", [[], ["--jobs", "1"], ["--executor", "thread"]]
+)
+def test_delete_identifiable_dicoms_script_basic(
+    script_runner, test_dir, data_dir, cohort_with_sequencename, extra_args
+):
 
-    # Add missing SequenceName to all dicom files in the test_dataset
-    dicom_files = glob.glob(
-        os.path.join(test_dir, "tmp", test_dataset, "*", "*", "*", "*.dcm")
+    test_dataset = "PACSMANCohort-delete_identifiable_dicoms" + "".join(extra_args)
+    # Clone the dataset with SequenceName set to tfl3d to a temporary folder
+    clone_cohort(
+        cohort_with_sequencename(os.path.join(data_dir, "PACSMANCohort"), "tfl3d"),
+        os.path.join(test_dir, "tmp", test_dataset),
     )
-    for dicom_file in dicom_files:
-        ds = pydicom.dcmread(dicom_file)
-        ds.SequenceName = "tfl3d"
-        ds.save_as(dicom_file)
 
     # Run the clean_series_tags script
     cmd = [
@@ -37,6 +41,7 @@ def test_delete_identifiable_dicoms_script_basic(script_runner, test_dir, data_d
         "--in_folder",
         os.path.join(test_dir, "tmp", test_dataset),
         "-t1w",
+        *extra_args,
     ]
 
     ret = script_runner.run(cmd)
@@ -47,7 +52,131 @@ def test_delete_identifiable_dicoms_script_basic(script_runner, test_dir, data_d
     assert "Deleted 128 files" in ret.stdout
 
     # Check that all dicom files have been deleted as SequenceName is tfl3d 
-    dicom_files = glob.glob(
-        os.path.join(test_dir, "tmp", test_dataset, "*", "*", "*", "*.dcm")
-    )
+    dicom_files = list(dcm_at_depth(os.path.join(test_dir, "tmp", test_dataset)))
     assert len(dicom_files) == 0
+
+
+def test_delete_identifiable_dicoms_script_dry_run(
+    script_runner, test_dir, data_dir, cohort_with_sequencename
+):
+
+    test_dataset = "PACSMANCohort-delete_identifiable_dicoms-dry_run"
+    # Clone the dataset with SequenceName set to tfl3d to a temporary folder
+    clone_cohort(
+        cohort_with_sequencename(os.path.join(data_dir, "PACSMANCohort"), "tfl3d"),
+        os.path.join(test_dir, "tmp", test_dataset),
+    )
+
+    # Run the delete_identifiable_dicoms script without deleting anything
+    cmd = [
+        "tml_ctp_delete_identifiable_dicoms",
+        "--in_folder",
+        os.path.join(test_dir, "tmp", test_dataset),
+        "-t1w",
+        "--dry-run",
+    ]
+
+    ret = script_runner.run(cmd)
+
+    # Check that the script has run successfully
+    assert ret.success
+
+    assert "Would delete 128 files" in ret.stdout
+
+    # Check that no dicom file has been deleted
+    dicom_files = list(dcm_at_depth(os.path.join(test_dir, "tmp", test_dataset)))
+    assert len(dicom_files) == 128
+
+
+def test_delete_identifiable_dicoms_script_mixed_series(
+    script_runner, test_dir, data_dir, cohort_with_mixed_imagetype
+):
+
+    test_dataset = "PACSMANCohort-delete_identifiable_dicoms-mixed_series"
+    test_dataset_dir = os.path.join(test_dir, "tmp", test_dataset)
+    # Clone the dataset with an ImageType to remove in all the files of the series
+    # but the first one, which should not spare the other files
+    clone_cohort(
+        cohort_with_mixed_imagetype(
+            os.path.join(data_dir, "PACSMANCohort"),
+            ["DERIVED", "SECONDARY", "SCREEN SAVE"],
+        ),
+        test_dataset_dir,
+    )
+    dicom_files = sorted(dcm_at_depth(test_dataset_dir))
+
+    # Run the delete_identifiable_dicoms script
+    cmd = [
+        "tml_ctp_delete_identifiable_dicoms",
+        "--in_folder",
+        test_dataset_dir,
+    ]
+
+    ret = script_runner.run(cmd)
+
+    # Check that the script has run successfully
+    assert ret.success
+
+    assert "Deleted 127 files" in ret.stdout
+
+    # Check that only the first dicom file has been kept
+    assert list(dcm_at_depth(test_dataset_dir)) == [dicom_files[0]]
+
+
+@pytest.mark.parametrize("jobs", ["0", "-1"])
+def test_delete_identifiable_dicoms_script_invalid_jobs(script_runner, data_dir, jobs):
+
+    # Run the delete_identifiable_dicoms script with an invalid number of jobs
+    cmd = [
+        "tml_ctp_delete_identifiable_dicoms",
+        "--in_folder",
+        os.path.join(data_dir, "PACSMANCohort"),
+        "--jobs",
+        jobs,
+    ]
+
+    ret = script_runner.run(cmd)
+
+    # Check that the script has failed before checking any file
+    assert not ret.success
+    assert "--jobs must be at least 1" in ret.stderr
+
+
+@pytest.mark.parametrize("elements", IDENTIFIABLE_SERIES_ELEMENTS)
+def test_delete_identifiable_dicom_series_folder(tmp_path, elements):
+    """Test that the folder of a flagged series is removed when it only holds the series files."""
+    series_dir = tmp_path / "series"
+    series_dir.mkdir()
+    filenames = [
+        write_dicom(series_dir / f"slice{i}.dcm", **elements) for i in range(3)
+    ]
+
+    assert delete_identifiable_dicom_series(filenames) == 3
+    assert not series_dir.exists()
+
+
+@pytest.mark.parametrize("elements", IDENTIFIABLE_SERIES_ELEMENTS)
+def test_delete_identifiable_dicom_series_files(tmp_path, elements):
+    """Test that only the files of a flagged series are deleted when its folder holds other files."""
+    series_dir = tmp_path / "series"
+    series_dir.mkdir()
+    filenames = [
+        write_dicom(series_dir / f"slice{i}.dcm", **elements) for i in range(3)
+    ]
+    (series_dir / "notes.txt").write_text("not part of the series")
+
+    assert delete_identifiable_dicom_series(filenames) == 3
+    assert os.listdir(series_dir) == ["notes.txt"]
+
+
+def test_delete_identifiable_dicom_series_not_flagged(tmp_path):
+    """Test that the files of a series whose series-level elements are not flagged are kept."""
+    series_dir = tmp_path / "series"
+    series_dir.mkdir()
+    filenames = [
+        write_dicom(series_dir / f"slice{i}.dcm", Modality="MR", SeriesDescription="T1w")
+        for i in range(3)
+    ]
+
+    assert delete_identifiable_dicom_series(filenames) == 0
+    assert sorted(os.listdir(series_dir)) == ["slice0.dcm", "slice1.dcm", "slice2.dcm"]
@@ -7,8 +7,12 @@
 """Main conftest.py file which defines some fixtures and configuration for the tests."""
 
 import os
+import shutil
+import pydicom
 import pytest
 
+from tests.utils import atomic_save, dcm_at_depth, patch_dicom_bytes
+
 
 @pytest.fixture(scope="session")
 def test_dir():
@@ -20,3 +24,122 @@ def test_dir():
 def data_dir(test_dir):
     """Return the path to the data directory."""
     return os.path.join(test_dir, "data")
+
+
+SERIESDATE_TAG = 0x00080021
+SERIESDATE_PLACEHOLDER = "19000101"
+
+
+@pytest.fixture(scope="session")
+def cohort_cache(tmp_path_factory):
+    """Return a function building a cohort snapshot once per test session.
+
+    The returned function takes the path of the source cohort, a string
+    describing the mutation applied to it (``spec``) and a ``build(source_dir,
+    snapshot_dir)`` callable, and returns the path to the snapshot.
+    """
+    snapshots = {}
+
+    def _get(source_dir, spec, build):
+        source_dir = os.path.abspath(source_dir)
+        spec = f"{os.path.basename(source_dir)}-{spec}"
+        if (source_dir, spec) not in snapshots:
+            snapshot_dir = str(tmp_path_factory.mktemp(spec) / "cohort")
+            build(source_dir, snapshot_dir)
+            snapshots[(source_dir, spec)] = snapshot_dir
+        return snapshots[(source_dir, spec)]
+
+    return _get
+
+
+@pytest.fixture(scope="session")
+def cohort_with_seriesdate(cohort_cache, tmp_path_factory):
+    """Return a factory building cohort snapshots with a given SeriesDate.
+
+    For each ``source_dir``, a template is built once by injecting a placeholder
+    SeriesDate in all its DICOM files with pydicom, and the offset of the value
+    in each file is recorded. Each ``(source_dir, series_date)`` variant is then
+    a copy of the template where the 8 bytes at the recorded offsets are patched,
+    without any further DICOM decoding or encoding.
+
+    Tests are expected to clone the returned snapshot with
+    :func:`tests.utils.clone_cohort` instead of rewriting the tags themselves.
+    """
+    templates = {}
+
+    def _template(source_dir):
+        if source_dir not in templates:
+            template_dir = str(tmp_path_factory.mktemp("seriesdate-template") / "cohort")
+            shutil.copytree(source_dir, template_dir)
+            offsets = {}
+            for dicom_file in list(dcm_at_depth(template_dir)):
+                ds = pydicom.dcmread(dicom_file)
+                ds.SeriesDate = SERIESDATE_PLACEHOLDER
+                atomic_save(ds, dicom_file)
+                elem = pydicom.dcmread(dicom_file, stop_before_pixels=True).get_item(
+                    SERIESDATE_TAG
+                )
+                offsets[os.path.relpath(dicom_file, template_dir)] = elem.value_tell
+            templates[source_dir] = (template_dir, offsets)
+        return templates[source_dir]
+
+    def _build(source_dir, series_date):
+        def _patch_series_date(source_dir, snapshot_dir):
+            template_dir, offsets = _template(source_dir)
+            shutil.copytree(template_dir, snapshot_dir)
+            for relpath, offset in offsets.items():
+                patch_dicom_bytes(
+                    os.path.join(snapshot_dir, relpath), offset, series_date.encode()
+                )
+
+        return cohort_cache(source_dir, f"seriesdate-{series_date}", _patch_series_date)
+
+    return _build
+
+
+@pytest.fixture(scope="session")
+def cohort_with_sequencename(cohort_cache):
+    """Return a factory building cohort snapshots with a given SequenceName.
+
+    Each ``(source_dir, sequence_name)`` variant is built once with pydicom and
+    cached by the ``cohort_cache`` fixture.
+    """
+
+    def _build(source_dir, sequence_name):
+        def _set_sequence_name(source_dir, snapshot_dir):
+            shutil.copytree(source_dir, snapshot_dir)
+            for dicom_file in list(dcm_at_depth(snapshot_dir)):
+                ds = pydicom.dcmread(dicom_file)
+                ds.SequenceName = sequence_name
+                atomic_save(ds, dicom_file)
+
+        return cohort_cache(
+            source_dir, f"sequencename-{sequence_name}", _set_sequence_name
+        )
+
+    return _build
+
+
+@pytest.fixture(scope="session")
+def cohort_with_mixed_imagetype(cohort_cache):
+    """Return a factory building cohort snapshots with a given ImageType in all files but one.
+
+    In each ``(source_dir, image_type)`` variant, the ImageType is set to
+    ``image_type`` in all the DICOM files but the first one, in path order,
+    which keeps its original ImageType. Variants are built once with pydicom
+    and cached by the ``cohort_cache`` fixture.
+    """
+
+    def _build(source_dir, image_type):
+        def _set_image_type(source_dir, snapshot_dir):
+            shutil.copytree(source_dir, snapshot_dir)
+            for dicom_file in sorted(dcm_at_depth(snapshot_dir))[1:]:
+                ds = pydicom.dcmread(dicom_file)
+                ds.ImageType = image_type
+                atomic_save(ds, dicom_file)
+
+        return cohort_cache(
+            source_dir, f"imagetype-mixed-{'-'.join(image_type)}", _set_image_type
+        )
+
+    return _build
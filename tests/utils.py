@@ -0,0 +1,105 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Helper functions shared by the tests and the fixtures."""
+
+import mmap
+import os
+import shutil
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+
+def dcm_at_depth(root, depth=3):
+    """Yield the ``.dcm`` files located exactly ``depth`` folders below ``root``.
+
+    This is equivalent to ``glob(os.path.join(root, *["*"] * depth, "*.dcm"))``
+    but walks the tree with ``os.scandir``, descending only into directories.
+
+    Args:
+        root (str): Path to the root folder, e.g. a cohort folder.
+        depth (int): Number of folder levels between ``root`` and the DICOM files.
+            Default to 3 (``sub-*/ses-*/<series>/*.dcm``).
+
+    Yields:
+        str: Path to a DICOM file.
+    """
+    with os.scandir(root) as it:
+        for entry in it:
+            if depth == 0:
+                if entry.name.endswith(".dcm"):
+                    yield entry.path
+            elif entry.is_dir(follow_symlinks=False):
+                yield from dcm_at_depth(entry.path, depth - 1)
+
+
+def atomic_save(ds, dicom_file):
+    """Save a pydicom Dataset by writing a new file and renaming it over ``dicom_file``.
+
+    ``dicom_file`` is never left half-written, even if saving fails.
+
+    Args:
+        ds (pydicom.Dataset): Dataset to save.
+        dicom_file (str): Path of the DICOM file to replace.
+    """
+    tmp_file = f"{dicom_file}.tmp"
+    ds.save_as(tmp_file)
+    os.replace(tmp_file, dicom_file)
+
+
+def patch_dicom_bytes(dicom_file, offset, value):
+    """Overwrite ``len(value)`` bytes of a DICOM file in place via ``mmap``.
+
+    This is only valid for fixed-length values (e.g. a DA element) whose
+    offset was recorded beforehand, as no element length is updated.
+
+    Args:
+        dicom_file (str): Path of the DICOM file to patch.
+        offset (int): Offset in bytes of the value to overwrite.
+        value (bytes): New value to write at ``offset``.
+    """
+    with open(dicom_file, "r+b") as f:
+        with mmap.mmap(f.fileno(), 0) as mm:
+            mm[offset : offset + len(value)] = value
+
+
+def clone_cohort(src_dir, dst_dir):
+    """Copy a cohort snapshot into a working directory.
+
+    The files are copied rather than hard linked: the scripts under test overwrite
+    DICOM files in place, which would otherwise also modify the snapshot.
+
+    Args:
+        src_dir (str): Path to the cohort snapshot to clone.
+        dst_dir (str): Path to the working directory to create.
+
+    Returns:
+        str: Path to the cloned cohort.
+    """
+    shutil.copytree(src_dir, dst_dir)
+    return dst_dir
+
+
+def write_dicom(dicom_file, **elements):
+    """Write a minimal DICOM file with the given header elements.
+
+    Args:
+        dicom_file (str): Path of the DICOM file to write.
+        **elements: Keywords and values of the header elements to set.
+
+    Returns:
+        str: Path to the written DICOM file.
+    """
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    for keyword, value in elements.items():
+        setattr(ds, keyword, value)
+    pydicom.dcmwrite(str(dicom_file), ds, write_like_original=False)
+    return str(dicom_file)
@@ -20,6 +20,8 @@ try:
     import getpass
 except ImportError:
     pass
+import errno
+import functools
 import json
 import os
 import os.path
@@ -27,12 +29,16 @@ import platform
 import sys
 import time
 import argparse
+import csv
 import shutil
 import subprocess
 import random
-import uuid
+import re
+import secrets
 import pydicom
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pydicom.errors import InvalidDicomError
 from pydicom.uid import generate_uid
 from typing import Tuple
 from pathlib import Path
@@ -41,119 +47,311 @@ from pathlib import Path
 from tml_ctp.info import __version__, __container_name__
 
 
-def is_windows_platform():
-    return platform.system() == "Windows"
+# The platform and the user / group IDs used to run the containers never change
+# during a run, so they are only looked up once at import
+_IS_WINDOWS = platform.system() == "Windows"
+_UID_GID = (getpass.getuser(), 0) if _IS_WINDOWS else (os.geteuid(), os.getegid())
+
+
+# Label of the containers started by DatContainerPool, to find any container left
+# behind by a killed run with `docker ps -a --filter label=<label>`
+DAT_CONTAINER_LABEL = f"{__container_name__}.pool"
+
+# Lines of the DAT scripts updated for each patient
+_DAT_SCRIPT_KEYS_PATTERN = re.compile(
+    r'n="(PatientID|PatientName|SeriesInstanceUID)"|t="(UIDROOT)"|(</script>)'
+)
 
 
 def run(cmd: list):
     """Run the given command using subprocess.run.
 
+    The standard output and error of the command are captured as text, so that they
+    can be printed in one block or reported if the command fails.
+
     Args:
-        cmd (list): Command to run to be passed to subprocess.Popen
+        cmd (list): Command to run to be passed to subprocess.run
+
+    Returns:
+        subprocess.CompletedProcess: The completed process, with `stdout` and `stderr` set
     """
-    process = subprocess.run(cmd)
+    process = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False
+    )
     return process
 
 
-def create_docker_dat_command(
-    input_folder: str,
+def get_inputs_root(input_folders: str, patient_folders: list) -> str:
+    """Get the folder to mount in the DAT containers to access all the patient folders.
+
+    This is the deepest common parent of `input_folders` and of the patient folders, with
+    their symbolic links resolved, so that patient folders linking to a location outside
+    of `input_folders` are available in the containers.
+
+    Args:
+        input_folders (str): Path to the parent folder including all folders of files to be anonymized
+        patient_folders (list): Names of the folders of files to be anonymized in `input_folders`
+
+    Returns:
+        str: Path to the folder to mount as ``/inputs`` in the containers
+    """
+    return os.path.commonpath(
+        [os.path.realpath(input_folders)]
+        + [
+            os.path.realpath(os.path.join(input_folders, patient_folder))
+            for patient_folder in patient_folders
+        ]
+    )
+
+
+def create_docker_pool_command(
+    input_folders: str,
+    patient_folders: list,
     output_folder: str,
-    dat_script: str,
+    script_dir: str,
     image_tag: str = f"{__container_name__}:{__version__}",
 ):
-    """Create the command to run DAT.jar with Docker.
+    """Create the command to start a long-lived container in which DAT.jar can be run.
 
-    This generates a command to run DAT.jar with Docker in the following format:
+    This generates a command to start a detached container in the following format:
 
-        docker run --rm \
+        docker run -d --rm \
+            --label <DAT_CONTAINER_LABEL> \
             -u <user_id>:<group_id> \
-            -v <input_folder>:/input \
-            -v <output_folder>:/output \
-            -v <dat_script>:/scripts/da.script \
+            -v <inputs_root>:/inputs:ro \
+            -v <output_folder>:/outputs \
+            -v <script_dir>:/scripts:ro \
+            --entrypoint sleep \
             <image_tag> \
-            -in /input \
-            -out /output \
-            -da /scripts/da.script
+            infinity
+
+    where `<inputs_root>` is given by :func:`get_inputs_root`, so that the command does not
+    grow with the number of patient folders.
 
     Args:
-        input_folder (str): Path to the folder of files to be anonymized
+        input_folders (str): Path to the parent folder including all folders of files to be anonymized
+        patient_folders (list): Names of the folders of files to be anonymized in `input_folders`
         output_folder (str): Path to the folder where the anonymized files will be saved
-        dat_script (str): Path to the DAT script to be used for anonymization
-        image_tag (str): Tag of the Docker image to use for running DAT.jar (default: ctp-anonymizer:<version>)
+        script_dir (str): Path to the folder where the DAT scripts to be used for anonymization are stored
+        image_tag (str): Tag of the Docker image to use for running DAT.jar (default: tml-ctp-anonymizer:<version>)
 
     Returns:
-        list: The command to run DAT.jar with Docker
+        list: The command to start the container with Docker
 
     """
 
-    if is_windows_platform():
-        user_id = getpass.getuser()
-        group_id = 0
-    else:  # Linux or Mac
-        user_id = os.geteuid()
-        group_id = os.getegid()
+    user_id, group_id = _UID_GID
 
     cmd = [
         "docker",
         "run",
+        "-d",
         "--rm",
+        "--label",
+        DAT_CONTAINER_LABEL,
         "-u",
         f"{user_id}:{group_id}",
         "-v",
-        f"{input_folder}:/input",
+        f"{get_inputs_root(input_folders, patient_folders)}:/inputs:ro",
         "-v",
-        f"{output_folder}:/output",
+        f"{os.path.abspath(output_folder)}:/outputs",
         "-v",
-        f"{dat_script}:/scripts/anonymizer.script",
+        f"{os.path.abspath(script_dir)}:/scripts:ro",
+        "--entrypoint",
+        "sleep",
         image_tag,
+        "infinity",
+    ]
+    return cmd
+
+
+def create_docker_exec_command(
+    container_id: str,
+    rel_input: str,
+    rel_output: str,
+    rel_script: str,
+):
+    """Create the command to run DAT.jar in a container started by :class:`DatContainerPool`.
+
+    This generates a command to run DAT.jar with Docker in the following format:
+
+        docker exec <container_id> \
+            /app/entrypoint_anonymizer.sh \
+            -in /inputs/<rel_input> \
+            -out /outputs/<rel_output> \
+            -da /scripts/<rel_script>
+
+    Args:
+        container_id (str): ID of the running container
+        rel_input (str): Path of the folder of files to be anonymized, relative to the mounted input folder
+        rel_output (str): Path of the folder where the anonymized files will be saved, relative to the mounted output folder
+        rel_script (str): Path of the DAT script to be used for anonymization, relative to the mounted script folder
+
+    Returns:
+        list: The command to run DAT.jar with Docker
+
+    """
+    cmd = [
+        "docker",
+        "exec",
+        container_id,
+        "/app/entrypoint_anonymizer.sh",
         "-in",
-        "/input",
+        f"/inputs/{rel_input}",
         "-out",
-        "/output",
+        f"/outputs/{rel_output}",
         "-da",
-        "/scripts/anonymizer.script",
+        f"/scripts/{rel_script}",
     ]
     return cmd
 
 
+class DatContainerPool:
+    """Pool of long-lived containers in which DAT.jar is run with ``docker exec``.
+
+    Creating a container with ``docker run`` for every patient folder is costly.
+    Instead, the pool starts ``size`` containers once, with the parent folder of the
+    patient folders (see :func:`get_inputs_root`), the output folder and the script
+    folder bind-mounted, and removes them on exit. Patient folders are then anonymized
+    in these containers with :func:`create_docker_exec_command`.
+
+    The containers are started with ``--rm`` and labelled with `DAT_CONTAINER_LABEL`,
+    so that the containers left behind if the process is killed can be removed with::
+
+        docker rm -f $(docker ps -aq --filter label=<DAT_CONTAINER_LABEL>)
+
+    Args:
+        input_folders (str): Path to the parent folder including all folders of files to be anonymized
+        patient_folders (list): Names of the folders of files to be anonymized in `input_folders`
+        output_folder (str): Path to the folder where the anonymized files will be saved
+        script_dir (str): Path to the folder where the DAT scripts to be used for anonymization are stored
+        image_tag (str): Tag of the Docker image to use for running DAT.jar (default: tml-ctp-anonymizer:<version>)
+        size (int): Number of containers to start
+
+    Example:
+
+        with DatContainerPool(input_folders, patient_folders, output_folder, script_dir, size=4) as pool:
+            container_id = pool.get_container_id(i)
+    """
+
+    def __init__(
+        self,
+        input_folders: str,
+        patient_folders: list,
+        output_folder: str,
+        script_dir: str,
+        image_tag: str = f"{__container_name__}:{__version__}",
+        size: int = 1,
+    ):
+        self.input_folders = input_folders
+        self.patient_folders = patient_folders
+        self.inputs_root = get_inputs_root(input_folders, patient_folders)
+        self.output_folder = output_folder
+        self.script_dir = script_dir
+        self.image_tag = image_tag
+        self.size = size
+        self.container_ids = []
+
+    def start(self):
+        """Start the containers of the pool.
+
+        Raises:
+            Exception: If a container fails to start.
+        """
+        cmd = create_docker_pool_command(
+            input_folders=self.input_folders,
+            patient_folders=self.patient_folders,
+            output_folder=self.output_folder,
+            script_dir=self.script_dir,
+            image_tag=self.image_tag,
+        )
+        print(f"Starting {self.size} DAT container(s) with command: {' '.join(cmd)}")
+        for _ in range(self.size):
+            process = subprocess.run(cmd, capture_output=True, text=True)
+            if process.returncode != 0:
+                self.stop()
+                raise Exception(
+                    f"Command {cmd} failed (return code {process.returncode}) "
+                    f"with the following error:\n {process.stderr}"
+                )
+            self.container_ids.append(process.stdout.strip())
+
+    def stop(self):
+        """Remove all the containers of the pool."""
+        for container_id in self.container_ids:
+            subprocess.run(["docker", "rm", "-f", container_id], capture_output=True)
+        self.container_ids = []
+
+    def get_container_id(self, index: int) -> str:
+        """Return the ID of the container to use for the `index`-th patient folder (round-robin)."""
+        return self.container_ids[index % len(self.container_ids)]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
 def run_dat(
     input_folder: str,
     output_folder: str,
     dat_script: str,
     temp_dir: str,
+    container_id: str,
     new_patient_id: str = None,
     dateinc: int = None,
-    image_tag: str = f"{__container_name__}:{__version__}",
+    inputs_root: str = None,
 ):
-    """Run DAT.jar with Docker given the input folder, output folder and DAT script.
+    """Run DAT.jar in a running container given the input folder, output folder and DAT script.
+
+    The container is expected to be started by :class:`DatContainerPool`, i.e. with
+    `inputs_root` mounted as ``/inputs`` (read-only), and the parent folder of
+    `output_folder` and the folder `temp_dir` mounted respectively as ``/outputs`` and
+    ``/scripts`` (read-only).
 
     Args:
         input_folder (str): Path to the folder of files to be anonymized.
         output_folder (str): Path to the folder where the anonymized files will be saved.
         dat_script (str): Path to the DAT script to be used for anonymization.
         temp_dir (str): Path to the temporary directory.
+        container_id (str): ID of the container in which DAT.jar is run.
         new_patient_id (str): New PatientID to use in the DAT script.
         dateinc (int): New DATEINC value to use in the DAT script.
-        image_tag (str): Tag of the Docker image to use for running DAT.jar (default: tml-ctp-anonymizer:<version>).
+        inputs_root (str): Folder mounted as ``/inputs`` in the container, which contains
+            `input_folder` once its symbolic links are resolved (default: the parent folder
+            of `input_folder`).
 
     Returns:
         tuple: Tuple containing the new PatientID, PatientName, DATEINC values, and the path to the modified DAT script.
 
     Raises:
-        Exception: If the Docker run command fails with a non-zero return code.
+        Exception: If the Docker exec command fails with a non-zero return code.
     """
-    # Update the DAT script with new PatientID, PatientName and DATEINC values
+    # Update the DAT script with new PatientID, PatientName and DATEINC values.
+    # The script is named after the patient folder so that it can be found in the
+    # script folder mounted once in the container.
+    input_folder_name = os.path.basename(os.path.normpath(input_folder))
     (new_patient_id, new_patient_name, new_series_uid, dateinc, updated_dat_script) = update_dat_script_file(
-        dat_script, temp_dir, new_patient_id=new_patient_id, dateinc=dateinc
+        dat_script,
+        temp_dir,
+        new_patient_id=new_patient_id,
+        dateinc=dateinc,
+        script_name=f"{input_folder_name}.script",
     )
     # Get the set of all patient names saved in dicoms
     patient_identifiers_set = get_patient_identifiers(input_folder)
-    # Create the command to run DAT.jar with Docker
-    cmd = create_docker_dat_command(
-        input_folder=input_folder,
-        output_folder=output_folder,
-        dat_script=updated_dat_script,
-        image_tag=image_tag,
+    # Create the command to run DAT.jar in the container
+    if inputs_root is None:
+        inputs_root = os.path.dirname(os.path.realpath(input_folder))
+    cmd = create_docker_exec_command(
+        container_id=container_id,
+        rel_input=Path(
+            os.path.relpath(os.path.realpath(input_folder), inputs_root)
+        ).as_posix(),
+        rel_output=os.path.basename(os.path.normpath(output_folder)),
+        rel_script=os.path.basename(updated_dat_script),
     )
     # Run the command
     print(f"Running DAT with command: {' '.join(cmd)}")
@@ -165,15 +363,98 @@ def run_dat(
     if process.returncode != 0:
         raise Exception(
             f"Command {cmd} failed (return code {process.returncode}) "
-            f"with the following error:\n {process.stderr}"
+            f"with the following output:\n {process.stdout}\n"
+            f"and the following error:\n {process.stderr}"
         )
+    # Print the DAT output in one block so that it does not interleave with other workers
+    print(process.stdout)
     # Check if patient name present in output folder
     check_and_rename_dicom_files(output_folder, patient_identifiers_set, str(new_series_uid))
     return (new_patient_id, new_patient_name, dateinc)
 
 
+@functools.lru_cache(maxsize=8)
+def load_dat_template(original_dat_script: str) -> Tuple[str, str]:
+    """Load a DAT script as a template in which the per-patient values are placeholders.
+
+    The DATEINC, PatientID, PatientName and SeriesInstanceUID values are replaced by the
+    ``__DATEINC__``, ``__PATIENT_ID__``, ``__PATIENT_NAME__`` and ``__SERIES_UID__`` placeholders.
+    The PatientID, PatientName, UIDROOT and SeriesInstanceUID lines are inserted before the
+    closing </script> tag if they do not exist. The result is cached so that the script is
+    only read and parsed once.
+
+    Args:
+        original_dat_script (str): Path to the original DAT script.
+
+    Returns:
+        tuple: Tuple containing the template and the UIDROOT prefix ending with a period.
+
+    Raises:
+        ValueError: If the DATEINC is not found in the second line of the DAT script.
+    """
+    # Read the lines from the original script file
+    with open(original_dat_script, "r") as f:
+        lines = f.readlines()
+
+    # Assuming the DATEINC is always at the second line
+    if "DATEINC" not in lines[1]:
+        raise ValueError("DATEINC not found in the second line of the DAT script")
+    lines[1] = ' <p t="DATEINC">__DATEINC__</p>\n'
+
+    # Find the end script tag and the first PatientID, PatientName, UIDROOT and
+    # SeriesInstanceUID lines in a single pass
+    line_indices = {}
+    for i, line in enumerate(lines):
+        match = _DAT_SCRIPT_KEYS_PATTERN.search(line)
+        if match:
+            line_indices.setdefault(match.group(match.lastindex), i)
+    end_script_index = line_indices.get("</script>")
+
+    patient_id_line = '<e en="T" t="00100020" n="PatientID">__PATIENT_ID__</e>\n'
+    patient_name_line = '<e en="T" t="00100010" n="PatientName">__PATIENT_NAME__</e>\n'
+    series_uid_line = '<e en="T" t="0020000E" n="SeriesInstanceUID">__SERIES_UID__</e>\n'
+
+    # Modify the lines that set the PatientID, the PatientName and the SeriesInstanceUID
+    for key, new_line in (
+        ("PatientID", patient_id_line),
+        ("PatientName", patient_name_line),
+        ("SeriesInstanceUID", series_uid_line),
+    ):
+        if key in line_indices:
+            lines[line_indices[key]] = new_line
+
+    # Extract the value of the UIDROOT
+    if "UIDROOT" in line_indices:
+        uidroot_line = lines[line_indices["UIDROOT"]]
+        uidroot_value = uidroot_line.split('>')[1].split('<')[0]  # Extract the value between the tags
+        # Ensure the prefix ends with a period
+        if not uidroot_value.endswith('.'):
+            uidroot_value += '.'
+    else:
+        default_uidroot = '1.2.826.0.1.3680043.8.498'
+        # Use the default value with a period for the prefix
+        uidroot_value = f'{default_uidroot}.'
+
+    # Insert the missing lines before the closing </script> tag. The indices found
+    # above are not affected as these lines are all before this tag.
+    if "PatientID" not in line_indices:
+        lines.insert(end_script_index, patient_id_line)
+    if "PatientName" not in line_indices:
+        lines.insert(end_script_index, patient_name_line)
+    if "UIDROOT" not in line_indices:
+        lines.insert(end_script_index, f'<p t="UIDROOT">{default_uidroot}</p>\n')
+    if "SeriesInstanceUID" not in line_indices:
+        lines.insert(end_script_index, series_uid_line)
+
+    return ("".join(lines), uidroot_value)
+
+
 def update_dat_script_file(
-    original_dat_script: str, temp_dir: str, new_patient_id: str = None, dateinc: int = None
+    original_dat_script: str,
+    temp_dir: str,
+    new_patient_id: str = None,
+    dateinc: int = None,
+    script_name: str = None,
 ) -> Tuple[str, str, int, str]:
     """Update the DAT script with a new DATEINC value, a new PatientID, and new random UUID for PatientName.
     Additionally, update or add SeriesInstanceUID.
@@ -182,8 +463,9 @@ def update_dat_script_file(
     If `dateinc` is `None`, a new random DATEINC value is generated between -30 and 30.
 
     This function assumes that the DATEINC is always at the second line of the DAT script.
-    The original DAT script is copied to a new script with a random number appended to the name,
-    and the modifications are applied to this new script.
+    The original DAT script is loaded once as a template with :func:`load_dat_template`, and
+    the new values are written to a new script named `script_name` (or with a random number
+    appended to the name if `script_name` is `None`).
 
     If the PatientID line or the PatientName line does not exist, they are appended to the end of the file.
     If the SeriesInstanceUID line does not exist, it is inserted before the closing </script> tag.
@@ -193,6 +475,7 @@ def update_dat_script_file(
         temp_dir (str): Path to a temporary directory where to store the copy of the DAT script.
         new_patient_id (str): New PatientID to use in the DAT script.
         dateinc (int): New DATEINC value to use in the DAT script.
+        script_name (str): File name of the new script in `temp_dir`.
 
     Returns:
         tuple: Tuple containing the new PatientID, PatientName, SeriesInstanceUID, DATEINC values, and the path to the modified DAT script.
@@ -200,91 +483,36 @@ def update_dat_script_file(
     Raises:
         ValueError: If the DATEINC is not found in the second line of the DAT script.
     """
-    # Generate a random number for the new script name
-    random_suffix = random_with_N_digits(8)
-    new_dat_script = os.path.join(temp_dir, f"anonymizer_{random_suffix}.script")
-
-    # Copy the original script to the new script with the random suffix
-    shutil.copyfile(original_dat_script, new_dat_script)
-
-    # Read the lines from the new script file
-    with open(new_dat_script, "r") as f:
-        lines = f.readlines()
-    # Find the index of end script tag
-    end_script_index = next((i for i, line in enumerate(lines) if '</script>' in line), None)
+    if script_name is None:
+        # Generate a random number for the new script name
+        random_suffix = random_with_N_digits(8)
+        script_name = f"anonymizer_{random_suffix}.script"
+    new_dat_script = os.path.join(temp_dir, script_name)
 
-    # Find the index of the end script tag
-    end_script_index = next((i for i, line in enumerate(lines) if '</script>' in line), None)
+    # Parse the original script only once and fill in the new values
+    (template, uidroot_value) = load_dat_template(original_dat_script)
 
-    # Assuming the DATEINC is always at the second line
-    if "DATEINC" not in lines[1]:
-        raise ValueError("DATEINC not found in the second line of the DAT script")
     if dateinc is None:
         dateinc = random.randint(-30, 30)
-    lines[1] = f' <p t="DATEINC">{dateinc}</p>\n'
-
-    # Generate a UUID for the PatientID
+    # Generate a random numeric PatientID
     if new_patient_id is None:
-        new_patient_id = str(uuid.uuid4().int)[:11]
-
-    # Find the line that sets the PatientID and modify it
-    patient_id_line_index = next(
-        (i for i, line in enumerate(lines) if 'n="PatientID"' in line), None
-    )
-    if patient_id_line_index is not None:
-        lines[patient_id_line_index] = (
-            f'<e en="T" t="00100020" n="PatientID">{new_patient_id}</e>\n'
-        )
-    else:
-        # If the PatientID line does not exist, append it to the end
-        lines.insert(end_script_index, f'<e en="T" t="00100020" n="PatientID">{new_patient_id}</e>\n')
-
-    # Generate a UUID for the PatientName
-    new_patient_name = str(uuid.uuid4().int)[:7]
-
-    # Find the line that sets the PatientName and modify it
-    patient_name_line_index = next(
-        (i for i, line in enumerate(lines) if 'n="PatientName"' in line), None
-    )
-    if patient_name_line_index is not None:
-        lines[patient_name_line_index] = (
-            f'<e en="T" t="00100010" n="PatientName">{new_patient_name}</e>\n'
-        )
-    else:
-        # If the PatientName line does not exist, append it to the end
-        lines.insert(end_script_index, f'<e en="T" t="00100010" n="PatientName">{new_patient_name}</e>\n')
-
-    # Find the line with UIDROOT and extract its value
-    uidroot_line = next((line for line in lines if 't="UIDROOT"' in line), None)
-    if uidroot_line:
-        uidroot_value = uidroot_line.split('>')[1].split('<')[0]  # Extract the value between the tags
-        # Ensure the prefix ends with a period
-        if not uidroot_value.endswith('.'):
-            uidroot_value += '.'
-    else:
-        # If UIDROOT line does not exist, insert it before the closing </script> tag
-        default_uidroot = '1.2.826.0.1.3680043.8.498'
-        lines.insert(end_script_index, f'<p t="UIDROOT">{default_uidroot}</p>\n')
-        
-        # Use the default value with a period for the prefix
-        uidroot_value = f'{default_uidroot}.'
-
+        new_patient_id = str(random_with_N_digits(11))
+    # Generate a random numeric PatientName
+    new_patient_name = str(random_with_N_digits(7))
     # Generate a new SeriesInstanceUID
     new_series_uid = generate_uid(prefix=uidroot_value)
-    # Find the line that sets the SeriesInstanceUID and modify it
-    series_uid_line_index = next(
-        (i for i, line in enumerate(lines) if 'n="SeriesInstanceUID"' in line), None
-    )
-    if series_uid_line_index is not None:
-        lines[series_uid_line_index] = (
-            f'<e en="T" t="0020000E" n="SeriesInstanceUID">{new_series_uid}</e>\n'
-        )
-    else:
-        # If the SeriesInstanceUID line does not exist, insert it before the closing </script> tag
-        lines.insert(end_script_index, f'<e en="T" t="0020000E" n="SeriesInstanceUID">{new_series_uid}</e>\n')
 
-    with open(new_dat_script, "w") as f:
-        f.writelines(lines)
+    script = (
+        template.replace("__DATEINC__", str(dateinc))
+        .replace("__PATIENT_ID__", str(new_patient_id))
+        .replace("__PATIENT_NAME__", new_patient_name)
+        .replace("__SERIES_UID__", new_series_uid)
+    )
+    # Write the new script atomically, so that DAT.jar never reads a partial script
+    fd, tmp_dat_script = tempfile.mkstemp(dir=temp_dir, suffix=".script.tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(script)
+    os.replace(tmp_dat_script, new_dat_script)
 
     return (
         new_patient_id,
@@ -295,6 +523,37 @@ def update_dat_script_file(
     )  # Return the generated values and the path to the new script as a tuple
 
 
+def move_series_folder(series_dir_path: str, new_series_dir_path: str):
+    """Move a series folder to its new location with a rename instead of a copy.
+
+    The parent folders of `new_series_dir_path` are created if needed. If
+    `new_series_dir_path` already exists, the files of `series_dir_path` are
+    moved into it one by one (overwriting files with the same name) and
+    `series_dir_path` is removed.
+
+    Args:
+        series_dir_path (str): Path to the series folder to move
+        new_series_dir_path (str): Path to the new series folder
+    """
+    os.makedirs(os.path.dirname(new_series_dir_path), exist_ok=True)
+    try:
+        os.rename(series_dir_path, new_series_dir_path)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            # Source and destination are on different devices
+            shutil.move(series_dir_path, new_series_dir_path)
+        elif os.path.isdir(new_series_dir_path):
+            # The destination already exists: merge the series files into it
+            for file in os.listdir(series_dir_path):
+                os.replace(
+                    os.path.join(series_dir_path, file),
+                    os.path.join(new_series_dir_path, file),
+                )
+            os.rmdir(series_dir_path)
+        else:
+            raise
+
+
 def rename_ctp_output_subject_folders(CTP_output_folder: str, subject_folder: str):
     """Rename the subject / session folders in the CTP output to match the new IDs generated by DAT.
 
@@ -308,75 +567,164 @@ def rename_ctp_output_subject_folders(CTP_output_folder: str, subject_folder: st
         subject_folder (str): Name of the subject folder to be renamed
 
     Raises:
-        Exception: If an error occurs while reading or copying the DICOM files
+        Exception: If an error occurs while reading or moving the DICOM files,
+            or while removing the original subject folder
     """
     print(f"Renaming {subject_folder}")
     print(f"CTP output folder: {CTP_output_folder}")
-    for session_dir in os.listdir(os.path.join(CTP_output_folder, subject_folder)):
-        session_dir_path = os.path.join(
-            os.path.join(CTP_output_folder, subject_folder), session_dir
-        )
-
-        for series_dir in os.listdir(session_dir_path):
-            series_dir_path = os.path.join(session_dir_path, series_dir)
+    subject_dir_path = os.path.join(CTP_output_folder, subject_folder)
+    if not os.path.isdir(subject_dir_path):
+        # DAT.jar did not produce any output for this subject (e.g. it failed)
+        print(f"WARNING: No CTP output folder {subject_dir_path} to rename")
+        return
+
+    # The folder listings are materialized as series folders are moved while iterating
+    with os.scandir(subject_dir_path) as it:
+        session_dir_paths = [entry.path for entry in it if entry.is_dir()]
+
+    for session_dir_path in session_dir_paths:
+        with os.scandir(session_dir_path) as it:
+            series_dir_paths = [entry.path for entry in it if entry.is_dir()]
+
+        for series_dir_path in series_dir_paths:
+            # Only the first DICOM file of the series is needed to get the new IDs, so the
+            # folder listing is consumed lazily and only up to that file. Files are not
+            # filtered on their extension as DICOM files often have none.
+            ds = None
+            with os.scandir(series_dir_path) as it:
+                for entry in it:
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    file_path = entry.path
+                    try:
+                        ds = pydicom.dcmread(
+                            file_path,
+                            stop_before_pixels=True,
+                            specific_tags=[
+                                "PatientID",
+                                "StudyDate",
+                                "StudyTime",
+                                "SeriesNumber",
+                                "SeriesDescription",
+                            ],
+                        )
+                    except InvalidDicomError:
+                        # Not a DICOM file, try the next one
+                        continue
+                    except Exception as e:
+                        raise Exception(
+                            f"An error occurred while reading {file_path}: {e}"
+                        )
+                    break
+            if ds is None:
+                print(f"WARNING: No DICOM file found in {series_dir_path}")
+                continue
 
-            for file in os.listdir(series_dir_path):
-                file_path = os.path.join(series_dir_path, file)
+            try:
+                new_patient_id = ds.PatientID
+                # Check if StudyDate and StudyTime attributes are present in the DICOM dataset object
+                new_study_date = (
+                    ds.StudyDate if hasattr(ds, "StudyDate") else "NoStudyDate"
+                )
+                new_study_time = (
+                    ds.StudyTime.split(".")[0] if hasattr(ds, "StudyTime") else "NoStudyTime"
+                )
+                new_series_number = (
+                    ds.SeriesNumber
+                    if hasattr(ds, "SeriesNumber")
+                    else "NoSeriesNumber"
+                )
+                new_series_desc = (
+                    ds.SeriesDescription
+                    if hasattr(ds, "SeriesDescription")
+                    else "NoSeriesDescription"
+                )
+            except Exception as e:
+                raise Exception(f"An error occurred while reading {file_path}: {e}")
+
+            print(f"New PatientID: {new_patient_id}")
+            print(f"New StudyDate: {new_study_date}")
+            print(f"New StudyTime: {new_study_time}")
+            print(f"New SeriesNumber: {new_series_number}")
+            print(f"New SeriesDescription: {new_series_desc}")
+
+            new_series_dir_path = os.path.join(
+                CTP_output_folder,
+                f"sub-{new_patient_id}",
+                f"ses-{new_study_date}{new_study_time}",
+                f"{new_series_number}_{new_series_desc}",
+            )
 
-                try:
-                    ds = pydicom.dcmread(file_path)
-                    new_patient_id = ds.PatientID
-                    # Check if StudyDate and StudyTime attributes are present in the DICOM dataset object
-                    new_study_date = (
-                        ds.StudyDate if hasattr(ds, "StudyDate") else "NoStudyDate"
-                    )
-                    new_study_time = (
-                        ds.StudyTime.split(".")[0] if hasattr(ds, "StudyTime") else "NoStudyTime"
-                    )
-                    new_series_number = (
-                        ds.SeriesNumber
-                        if hasattr(ds, "SeriesNumber")
-                        else "NoSeriesNumber"
-                    )
-                    new_series_desc = (
-                        ds.SeriesDescription
-                        if hasattr(ds, "SeriesDescription")
-                        else "NoSeriesDescription"
-                    )
-                except Exception as e:
-                    raise Exception(f"An error occurred while reading {file_path}: {e}")
-
-                print(f"New PatientID: {new_patient_id}")
-                print(f"New StudyDate: {new_study_date}")
-                print(f"New StudyTime: {new_study_time}")
-                print(f"New SeriesNumber: {new_series_number}")
-                print(f"New SeriesDescription: {new_series_desc}")
-
-                new_series_dir_path = os.path.join(
-                    CTP_output_folder,
-                    f"sub-{new_patient_id}",
-                    f"ses-{new_study_date}{new_study_time}",
-                    f"{new_series_number}_{new_series_desc}",
+            try:
+                print(f"Renaming {series_dir_path} to {new_series_dir_path}")
+                move_series_folder(series_dir_path, new_series_dir_path)
+            except Exception as e:
+                raise Exception(
+                    f"An error occurred while moving {series_dir_path} to {new_series_dir_path}: {e}"
                 )
 
-                try:
-                    print(f"Renaming {series_dir_path} to {new_series_dir_path}")
-                    shutil.copytree(
-                        series_dir_path,
-                        new_series_dir_path,
-                        symlinks=False,
-                        ignore=None,
-                        ignore_dangling_symlinks=False,
-                        dirs_exist_ok=True,
-                    )
-                    shutil.rmtree(series_dir_path, ignore_errors=True)
-                except Exception as e:
-                    raise Exception(
-                        f"An error occurred while copying {series_dir_path} to {new_series_dir_path}: {e}"
-                    )
+    # Remove the old subject folder, which is named after the original PatientID, with
+    # anything left in it (e.g. series without any DICOM file). Errors are not ignored
+    # so that identifying folders are never left silently in the anonymized output.
+    try:
+        shutil.rmtree(subject_dir_path)
+    except Exception as e:
+        raise Exception(f"An error occurred while removing {subject_dir_path}: {e}")
+
 
-                break
-    shutil.rmtree(os.path.join(CTP_output_folder, subject_folder), ignore_errors=True)
+def process_one(
+    folder: str,
+    input_folders: str,
+    CTP_output_folder: str,
+    dat_script: str,
+    temp_dir: str,
+    container_id: str,
+    new_patient_id: str = None,
+    dateinc: int = None,
+    inputs_root: str = None,
+) -> Tuple[str, str, int]:
+    """Anonymize the DICOM files of one patient folder and rename its CTP output folders.
+
+    This function is submitted to a :class:`concurrent.futures.ThreadPoolExecutor`.
+    Threads are enough as most of the time is spent waiting for DAT.jar to run in
+    its container.
+
+    Args:
+        folder (str): Name of the patient folder in `input_folders`.
+        input_folders (str): Parent folder including all folders of files to be anonymized.
+        CTP_output_folder (str): Folder where the anonymized files will be saved.
+        dat_script (str): Path to the DAT script to be used for anonymization.
+        temp_dir (str): Path to the temporary directory.
+        container_id (str): ID of the container in which DAT.jar is run.
+        new_patient_id (str): New PatientID to use in the DAT script.
+        dateinc (int): New DATEINC value to use in the DAT script.
+        inputs_root (str): Folder mounted as ``/inputs`` in the container (see :func:`run_dat`).
+
+    Returns:
+        tuple: Tuple containing the patient folder, the new PatientID and the DATEINC value.
+    """
+    print(f"Processing {folder}")
+    try:
+        # No need to create the output folder of the patient: the whole output folder
+        # is mounted in the DAT containers and DAT.jar creates it
+        (new_patient_id, _, dateinc) = run_dat(
+            input_folder=os.path.join(input_folders, folder),
+            output_folder=os.path.join(CTP_output_folder, folder),
+            dat_script=dat_script,
+            temp_dir=temp_dir,  # Pass the temporary directory
+            container_id=container_id,
+            new_patient_id=new_patient_id,
+            dateinc=dateinc,
+            inputs_root=inputs_root,
+        )
+    except Exception as e:
+        # TODO: see how to handle this error (e.g. break, continue, etc.)
+        print(f"An error occurred while processing {folder}: {e}")
+
+    # Rename the subject / session folders in the CTP output to match the new IDs generated by DAT
+    rename_ctp_output_subject_folders(CTP_output_folder, folder)
+
+    return (folder, new_patient_id, dateinc)
 
 
 def get_parser():
@@ -430,6 +778,15 @@ def get_parser():
         default=f"quay.io/translationalml/{__container_name__}:{__version__}",
         help="Tag of the Docker image to use for running DAT.jar (default: tml-ctp-anonymizer:<version>).",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="Number of patient folders to anonymize in parallel "
+        "(default: half the number of CPUs).",
+    )
     parser.add_argument(
         "--version",
         action="version",
@@ -438,6 +795,26 @@ def get_parser():
     return parser
 
 
+def iter_dicom_files(dicom_folder: str):
+    """Recursively yield the paths of the ``.dcm`` files in the specified folder.
+
+    This is shared by :func:`get_patient_identifiers` and :func:`check_and_rename_dicom_files`.
+    :func:`os.walk` already lists the folders with :func:`os.scandir`, so files are
+    filtered on their names without being stat-ed.
+
+    Args:
+        dicom_folder (str): Path to the folder containing DICOM files.
+
+    Yields:
+        Path: Path of each DICOM file found in the folder and its subfolders.
+    """
+    for root, _, files in os.walk(dicom_folder):
+        root_path = Path(root)
+        for file in files:
+            if file.endswith(".dcm"):
+                yield root_path / file
+
+
 def check_and_rename_dicom_files(dicom_folder: str, patient_identifiers: set[str], replacement_string: str) -> None:
     """Check if any DICOM filename contains any of the patient names and, if found, rename the files with anonymized filenames.
 
@@ -449,26 +826,17 @@ def check_and_rename_dicom_files(dicom_folder: str, patient_identifiers: set[str
         patient_identifiers (set[str]): A set of strings representing patient identifiers to check for in the DICOM filenames.
         replacement_string (str): The string to replace the patient name with.
     """
-    any_needs_renaming = False
+    # Match all the patient identifiers at once, ignoring case
+    identifiers = sorted((p for p in patient_identifiers if p), key=len, reverse=True)
+    if not identifiers:
+        return
+    identifiers_pattern = re.compile("|".join(map(re.escape, identifiers)), re.IGNORECASE)
 
     # Gather all DICOM file paths
-    file_paths = []
-    for root, _, files in os.walk(dicom_folder):
-        for file in files:
-            if file.endswith(".dcm"):
-                file_paths.append(Path(root) / file)
+    file_paths = list(iter_dicom_files(dicom_folder))
 
     # First pass to check if any file contains the patient names
-    for file_path in file_paths:
-        try:
-            for patient_identifier in patient_identifiers:
-                if patient_identifier.lower() in file_path.name.lower():
-                    any_needs_renaming = True
-                    break
-            if any_needs_renaming:
-                break
-        except Exception as e:
-            print(f"An error occurred while processing {file_path}: {e}")
+    any_needs_renaming = any(identifiers_pattern.search(file_path.name) for file_path in file_paths)
 
     # If any file contains a patient name, proceed with renaming
     if any_needs_renaming:
@@ -476,9 +844,7 @@ def check_and_rename_dicom_files(dicom_folder: str, patient_identifiers: set[str
         for index, file_path in enumerate(file_paths, start=0):
             try:
                 # Prepare new filename
-                new_filename = file_path.name
-                for patient_identifier in patient_identifiers:
-                    new_filename = f"{replacement_string}.{index}.dcm"
+                new_filename = f"{replacement_string}.{index}.dcm"
 
                 # Rename file
                 new_file_path = file_path.with_name(new_filename)
@@ -488,10 +854,32 @@ def check_and_rename_dicom_files(dicom_folder: str, patient_identifiers: set[str
                 print(f"An error occurred while processing {file_path}: {e}")
 
 
+def read_patient_name(file_path: Path) -> str:
+    """Read the PatientName of a DICOM file.
+
+    Only the PatientName is parsed: the rest of the header and the pixel data are skipped.
+
+    Args:
+        file_path (Path): Path to the DICOM file.
+
+    Returns:
+        str: The PatientName, or an empty string if the file could not be read.
+    """
+    try:
+        ds = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["PatientName"])
+        return str(ds.PatientName).strip()
+    except Exception as e:
+        print(f"An error occurred while processing {file_path}: {e}")
+        return ""
+
+
 def get_patient_identifiers(dicom_folder: str) -> set[str]:
     """
     Get a set of unique patient identifiers from the DICOM files in the specified folder.
 
+    The files are read sequentially, as the patient folders are already processed
+    in parallel (see `--jobs`).
+
     Args:
         dicom_folder (str): Path to the folder containing DICOM files.
 
@@ -500,23 +888,14 @@ def get_patient_identifiers(dicom_folder: str) -> set[str]:
     """
     patient_identifiers = set()
 
-    for root, _, files in os.walk(dicom_folder):
-        for file in files:
-            if file.endswith(".dcm"):
-                file_path = Path(root) / file
-                try:
-                    ds = pydicom.dcmread(file_path)
-                    patient_name = str(ds.PatientName).strip()
-
-                    # Split the patient name by spaces and carets (^)
-                    name_parts = patient_name.replace('^', ' ').split()
+    for dicom_file in iter_dicom_files(dicom_folder):
+        # Split the patient name by spaces and carets (^)
+        name_parts = read_patient_name(dicom_file).replace('^', ' ').split()
 
-                    # Add each part to the set of patient identifiers
-                    for part in name_parts:
-                        if part:  # Avoid adding empty strings
-                            patient_identifiers.add(part)
-                except Exception as e:
-                    print(f"An error occurred while processing {file_path}: {e}")
+        # Add each part to the set of patient identifiers
+        for part in name_parts:
+            if part:  # Avoid adding empty strings
+                patient_identifiers.add(part)
 
     return patient_identifiers
 
@@ -537,18 +916,8 @@ def random_with_N_digits(n: int) -> int:
     if n <= 0:
         raise ValueError("Number of digits must be greater than 0")
 
-    random_instance = random.Random()
-
-    # Generate the first digit from 1 to 9 to ensure it is not zero
-    first_digit = random_instance.choice('123456789')
-
-    # Generate the remaining digits from 0 to 9
-    remaining_digits = ''.join(random_instance.choices('0123456789', k=n - 1))
-
-    # Combine the digits into a single number
-    number = int(first_digit + remaining_digits)
-
-    return number
+    # The lower bound ensures that the first digit is not zero
+    return 10 ** (n - 1) + secrets.randbelow(9 * 10 ** (n - 1))
 
 
 def main():
@@ -563,8 +932,6 @@ def main():
     The script also writes the mapping between the old and new IDs to a file.
 
     """
-    start_time = time.time()
-
     parser = get_parser()
     args = parser.parse_args()
     input_folders = args.input_folders
@@ -604,6 +971,11 @@ def main():
             )
             sys.exit(1)
 
+        # Check that at least one patient folder is anonymized at a time
+        if args.jobs < 1:
+            print(f"ERROR: The number of jobs must be at least 1, got {args.jobs}!")
+            sys.exit(1)
+
         # Create the output folder if it does not exist
         os.makedirs(CTP_output_folder, exist_ok=True)
 
@@ -626,74 +998,94 @@ def main():
                 except json.JSONDecodeError as e:
                     print(f"An error occurred while loading the day shifts file: {e}")
                     sys.exit(1)
-                # Check that the day shifts are integers
-                for k, v in day_shifts.items():
-                    if not isinstance(v, int):
-                        print(
-                            f"ERROR: The day shift for patient {k} is not an integer. Please check the file!"
-                        )
-                        sys.exit(1)
+                # Check that the day shifts are integers (booleans are integers in Python)
+                # and report all the invalid ones at once
+                bad_patients = [
+                    k
+                    for k, v in day_shifts.items()
+                    if not isinstance(v, int) or isinstance(v, bool)
+                ]
+                if bad_patients:
+                    print(
+                        f"ERROR: The day shifts for patients {', '.join(bad_patients)} are not integers. "
+                        "Please check the file!"
+                    )
+                    sys.exit(1)
         else:
             day_shifts = None
 
         # Get the list of all patient folders
-        all_patient_folders = [
-            dir
-            for dir in os.listdir(input_folders)
-            if os.path.isdir(os.path.join(input_folders, dir))
-        ]
-        all_patient_folders.sort()
-
-        # Create a file to store the mapping between the old and new IDs and the DATEINC values
+        with os.scandir(input_folders) as it:
+            all_patient_folders = sorted(entry.name for entry in it if entry.is_dir())
 
+        # Create a file to store the mapping between the old and new IDs and the DATEINC values,
+        # named after the parent folder of the input folder (platform-independent with pathlib).
+        # Fall back to "root" when the input folder is at the root of the filesystem.
         input_path = Path(input_folders).resolve()
-        parent_dir_name = input_path.parent.name if input_path.parent != input_path else input_path.name
+        parent_dir_name = input_path.parent.name or "root"
         CTP_ids_file = os.path.join(
             CTP_output_folder, f"CTP_{parent_dir_name}_newids_dateinc_log.csv"
         )
-        with open(CTP_ids_file, "a") as file:
-            for i, folder in enumerate(all_patient_folders):
-                print(f"Processing {folder} [{i+1}/{len(all_patient_folders)}]")
-
-                if new_patient_ids is not None:
-                    new_patient_id = new_patient_ids[folder]
-                else:
-                    new_patient_id = None
-
-                if day_shifts is not None:
-                    dateinc = day_shifts[folder]
-                else:
-                    dateinc = None
-
-                try:
-                    os.makedirs(os.path.join(CTP_output_folder, folder), exist_ok=True)
-                    (new_patient_id, _, dateinc) = run_dat(
-                        input_folder=os.path.join(input_folders, folder),
-                        output_folder=os.path.join(CTP_output_folder, folder),
+        with open(CTP_ids_file, "a", newline="") as file, DatContainerPool(
+            input_folders=input_folders,
+            patient_folders=all_patient_folders,
+            output_folder=CTP_output_folder,
+            script_dir=temp_dir,
+            image_tag=image_tag,
+            # No need for more containers than patient folders
+            size=min(args.jobs, len(all_patient_folders)),
+        ) as pool, ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            try:
+                futures = [
+                    executor.submit(
+                        process_one,
+                        folder,
+                        input_folders=input_folders,
+                        CTP_output_folder=CTP_output_folder,
                         dat_script=dat_script,
-                        temp_dir=temp_dir,  # Pass the temporary directory
-                        new_patient_id=new_patient_id,
-                        dateinc=dateinc,
-                        image_tag=image_tag,
+                        temp_dir=temp_dir,
+                        container_id=pool.get_container_id(i),
+                        new_patient_id=(
+                            new_patient_ids[folder] if new_patient_ids is not None else None
+                        ),
+                        dateinc=day_shifts[folder] if day_shifts is not None else None,
+                        inputs_root=pool.inputs_root,
                     )
-                except Exception as e:
-                    # TODO: see how to handle this error (e.g. break, continue, etc.)
-                    print(f"An error occurred while processing {folder}: {e}")
-
-                # Rename the subject / session folders in the CTP output to match the new IDs generated by DAT
-                rename_ctp_output_subject_folders(CTP_output_folder, folder)
-
-                # Write the mapping between the old and new IDs and the DATEINC values to the file
-                info = f"{folder}, sub-{new_patient_id}, {dateinc}\n"
-                file.write(info)
-                file.flush()
-                print(info)
-
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                expected_time_per_iteration = elapsed_time / (i + 1)
-                expected_total_time = expected_time_per_iteration * len(all_patient_folders)
-                print(f"Expected total time: {expected_total_time} seconds")
+                    for i, folder in enumerate(all_patient_folders)
+                ]
+
+                # Write the results from the main thread as the patient folders complete, so
+                # that the file does not need a lock.
+                # The ETA is based on an exponential moving average of the time between
+                # two completions, which accounts for the patients processed in parallel.
+                n_folders = len(all_patient_folders)
+                writer = csv.writer(file, lineterminator="\n")
+                alpha = 0.2
+                ema = 0.0
+                last_time = time.monotonic()
+                for i, future in enumerate(as_completed(futures)):
+                    (folder, new_patient_id, dateinc) = future.result()
+                    print(f"Processed {folder} [{i+1}/{n_folders}]")
+
+                    # Write the mapping between the old and new IDs and the DATEINC values to the file
+                    info = [folder, f"sub-{new_patient_id}", dateinc]
+                    writer.writerow(info)
+                    # Flush periodically rather than for every patient. Remaining rows
+                    # are flushed when the file is closed, including on errors.
+                    if (i + 1) % 16 == 0:
+                        file.flush()
+                    print(", ".join(map(str, info)))
+
+                    now = time.monotonic()
+                    dt = now - last_time
+                    last_time = now
+                    ema = alpha * dt + (1 - alpha) * ema if i else dt
+                    print(f"Expected remaining time: {(n_folders - i - 1) * ema:.1f} seconds")
+            except BaseException:
+                # Do not start the patient folders still queued after an error or an
+                # interruption (e.g. Ctrl-C), instead of waiting for all of them on exit
+                executor.shutdown(cancel_futures=True)
+                raise
 
     finally:
         # Cleanup the temporary directory
@@ -8,12 +8,16 @@
 
 """Script to clean tags at all levels in DICOM data."""
 
-import numpy as np
-import pandas as pd
+import csv
 from os.path import join
 import os
 import pydicom
+from pydicom.multival import MultiValue
+from pydicom.tag import BaseTag
+from pydicom.valuerep import PersonName
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 def find_ref_image(root_dir: str):
@@ -27,10 +31,23 @@ def find_ref_image(root_dir: str):
     Returns:
         str: Full path to the first file encountered or None if no files are found.
     """
-
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        if filenames:  # If there are files in the current directory
-            return os.path.join(dirpath, filenames[0])
+    # Depth-first traversal with os.scandir, returning as soon as a file is found.
+    # Folders are visited in the same order as with os.walk, so the same file is returned.
+    dirs_to_visit = [root_dir]
+    while dirs_to_visit:
+        try:
+            it = os.scandir(dirs_to_visit.pop())
+        except OSError:
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    return entry.path
+        # Visit the first subfolder first
+        dirs_to_visit.extend(reversed(subdirs))
     return None
 
 
@@ -99,15 +116,17 @@ def replace_str_in_number(elem_value, initial_str: str, new_str: str):
         new_str (str): New string to replace the initial string
 
     Returns:
-        int or float: Number with the replaced string
+        int or float: Number with the replaced string, or the same number if it does not
+        contain the initial string
     """
-    # Save the type of the element value
-    elem_value_type = type(elem_value)
     # Convert the element value to a string
     elem_value_str = str(elem_value)
+    # Most numbers do not contain the initial string: keep them as they are
+    if initial_str not in elem_value_str:
+        return elem_value
     # Replace the initial string with the new string and convert back
     # to the original type
-    return elem_value_type(elem_value_str.replace(initial_str, new_str))
+    return type(elem_value)(elem_value_str.replace(initial_str, new_str))
 
 
 def replace_substr_in_tag(
@@ -149,12 +168,87 @@ def replace_substr_in_tag(
 # print(replace_substr_in_tag('<tag>some sensitive info</tag>', 'sensitive', 'replaced', '<tag>', 'This is a <replaced> secret </replaced>'))
 
 
+def replace_strs_in_value(value, tag_pairs: list):
+    """Function to replace all the strings of the given pairs in a single data element value.
+
+    It handles the cases where the value is a string, a person name or a number.
+    Other values (e.g. bytes or tags) are returned unchanged.
+
+    Args:
+        value: Data element value in which to replace the strings
+        tag_pairs (list): List of [initial_str, new_str] pairs
+
+    Returns:
+        The value with the replaced strings
+    """
+    if isinstance(value, str):
+        for initial_str, new_str in tag_pairs:
+            value = value.replace(initial_str, new_str)
+    elif isinstance(value, PersonName):
+        value_str = str(value)
+        for initial_str, new_str in tag_pairs:
+            value_str = value_str.replace(initial_str, new_str)
+        value = PersonName(value_str)
+    elif isinstance(value, BaseTag):
+        # Handle case when the value of a tag is a tag e.g. '(0020, 9056)'.
+        # Otherwise it is seen as int or float and raises an error.
+        pass
+    elif isinstance(value, (int, float)):
+        for initial_str, new_str in tag_pairs:
+            if initial_str.isnumeric():
+                value = replace_str_in_number(value, initial_str, new_str)
+    return value
+
+
+def anonymize_tags(ds: pydicom.Dataset, tag_pairs: list):
+    """Function to anonymize / replace first level and nested tags in a pydicom Dataset.
+
+    All the data elements, including the ones nested in sequences, are visited once with
+    :meth:`pydicom.Dataset.iterall`, and all the pairs are replaced in each of them.
+    Pairs with an empty initial string or with identical strings are ignored.
+    Single values and multi-values (with backslash separator) are handled with
+    :func:`replace_strs_in_value`.
+
+    Args:
+        ds : pydicom Dataset to anonymize
+        tag_pairs : List of [initial_str, new_str] pairs to replace
+
+    Returns:
+        tuple: Pydicom Dataset with the replaced tag values and whether any value was changed
+    """
+    # Drop the pairs that would not change anything (e.g. a SeriesDate shifted by 0 days)
+    # and the empty initial strings, which str.replace() would match everywhere
+    tag_pairs = [
+        (initial_str, new_str)
+        for initial_str, new_str in tag_pairs
+        if initial_str and initial_str != new_str
+    ]
+    if not tag_pairs:
+        return ds, False
+
+    changed = False
+    for elem in ds.iterall():
+        if elem.VR == "SQ":
+            # The items of the sequence are visited by iterall()
+            continue
+        value = elem.value
+        if isinstance(value, (MultiValue, list, tuple)):
+            new_value = [replace_strs_in_value(item, tag_pairs) for item in value]
+            if new_value != list(value):
+                elem.value = new_value
+                changed = True
+        else:
+            new_value = replace_strs_in_value(value, tag_pairs)
+            if new_value != value:
+                elem.value = new_value
+                changed = True
+    return ds, changed
+
+
 def anonymize_tag_recurse(ds: pydicom.Dataset, initial_str: str, new_str: str):
     """Function to anonymize / replace first level and nested tags in a pydicom Dataset recursively.
 
-    It handles the cases where the value of the data element is one of the following:
-    a single string value, a number, a list or tuple with all strings or all numbers,
-    or a multi-value string with backslash separator.
+    This is equivalent to calling :func:`anonymize_tags` with a single pair.
 
     Args:
         ds : pydicom Dataset to anonymize
@@ -164,37 +258,26 @@ def anonymize_tag_recurse(ds: pydicom.Dataset, initial_str: str, new_str: str):
     Returns:
         ds : Pydicom Dataset with the replaced tag values
     """
-    for elem in ds:
-        if elem.VR == "SQ":
-            [anonymize_tag_recurse(item, initial_str, new_str) for item in elem.value]
-        else:
-            if isinstance(elem.value, str):
-                if "\\" in elem.value:
-                    elem.value = "\\".join(
-                        [
-                            value.replace(initial_str, new_str)
-                            for value in elem.value.split("\\")
-                        ]
-                    )
-                else:
-                    elem.value = elem.value.replace(initial_str, new_str)
-            elif isinstance(elem.value, pydicom.tag.BaseTag):
-                # Handle case when the value of a tag is a tag e.g. '(0020, 9056)'.
-                # Otherwise it is seen as int or float and raises an error.
-                pass
-            elif isinstance(elem.value, int) or isinstance(elem.value, float):
-                if initial_str.isnumeric():
-                    elem.value = replace_str_in_number(elem.value, initial_str, new_str)
-            elif isinstance(elem.value, list) or isinstance(elem.value, tuple):
-                for i, value in enumerate(elem.value):
-                    if isinstance(value, str):
-                        elem.value[i] = value.replace(initial_str, new_str)
-                    elif isinstance(elem.value, int) or isinstance(elem.value, float):
-                        if initial_str.isnumeric():
-                            elem.value = replace_str_in_number(
-                                elem.value, initial_str, new_str
-                            )
-    return ds
+    return anonymize_tags(ds, [[initial_str, new_str]])[0]
+
+
+def clean_one_file(ctp_file_path: str, dangerous_tag_pairs: list):
+    """Replace the dangerous tag values at all levels of a DICOM file and overwrite it if any changed.
+
+    This function is defined at the module level so that it can be run
+    in a :class:`concurrent.futures.ProcessPoolExecutor`.
+
+    Args:
+        ctp_file_path (str): Path to the DICOM file to clean
+        dangerous_tag_pairs (list): List of [initial_str, new_str] pairs to replace
+    """
+    ctp_file_image = pydicom.dcmread(ctp_file_path)
+    ctp_dicom_corrected, changed = anonymize_tags(ctp_file_image, dangerous_tag_pairs)
+    if not changed:
+        # Nothing to overwrite
+        return
+
+    ctp_dicom_corrected.save_as(ctp_file_path)  # No turning back
 
 
 def get_parser():
@@ -213,6 +296,13 @@ def get_parser():
         type=str,
         help="Path to the IDs file generated byt the CTP batcher file.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of DICOM files to clean in parallel (default: the number of CPUs).",
+    )
     return parser
 
 
@@ -238,51 +328,59 @@ def main():
     if not os.path.isfile(ids_file):
         raise FileNotFoundError(f"{ids_file} is not a file")
 
-    # Load the IDs file
-    ids_pairs = pd.read_csv(
-        ids_file,
-        delimiter=",",
-        skipinitialspace=True,
-        dtype=str,
-        header=None
-    ).to_numpy(dtype=str)
-    # ids_pairs = np.genfromtxt(ids_file, delimiter=', ', dtype=str)
-
-    # [Patch] just to be able to handle single folder cases inside the ids_file
-    if not isinstance(ids_pairs[0], np.ndarray):
-        ids_pairs = np.array([ids_pairs])
-
-    for idx, pair in enumerate(ids_pairs):
-        print(idx, len(ids_pairs))
-
-        original_subject_folder = join(original_cohort, pair[0])
-        ctp_subject_folder = join(CTP_data_folder, pair[1])
-
-        # [Todo] needs an exception when it can't find the pair of tags
-        dangerous_tag_pairs, list_issues = get_dangerous_tag_pairs(
-            original_subject_folder, ctp_subject_folder
-        )
-        print(dangerous_tag_pairs)
+    # Check that at least one file is cleaned at a time
+    if args.jobs < 1:
+        raise ValueError(f"--jobs must be at least 1, got {args.jobs}")
+
+    # Load the IDs file, one [original folder, CTP folder, DATEINC] row per subject
+    with open(ids_file, newline="") as file:
+        ids_pairs = [
+            [value.strip() for value in row]
+            for row in csv.reader(file, skipinitialspace=True)
+            if row
+        ]
 
-        if len(list_issues) > 0:
+    # Issues are collected and written to the log file once at the end
+    issues_log = []
+
+    try:
+        # The files are cleaned in parallel, in a pool shared by all the subjects
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for idx, pair in enumerate(ids_pairs):
+                print(idx, len(ids_pairs))
+
+                original_subject_folder = join(original_cohort, pair[0])
+                ctp_subject_folder = join(CTP_data_folder, pair[1])
+
+                # [Todo] needs an exception when it can't find the pair of tags
+                dangerous_tag_pairs, list_issues = get_dangerous_tag_pairs(
+                    original_subject_folder, ctp_subject_folder
+                )
+                print(dangerous_tag_pairs)
+
+                if len(list_issues) > 0:
+                    issues_log.append(f"{pair[0]} {pair[1]} {list_issues} \n")
+
+                ctp_file_paths = []
+                for dirpath, _, filenames in os.walk(ctp_subject_folder):
+                    print(f"> Clean {dirpath}")
+                    for filename in filenames:
+                        ctp_file_paths.append(join(dirpath, filename))
+
+                # Consume the results so that errors in the workers are raised
+                for _ in executor.map(
+                    clean_one_file,
+                    ctp_file_paths,
+                    repeat(dangerous_tag_pairs),
+                    chunksize=32,
+                ):
+                    pass
+    finally:
+        # Write the issues found so far, even if cleaning a file failed
+        if issues_log:
             log_file = join(CTP_data_folder, "all_file_issues.txt")
             with open(log_file, "a") as file:
-                file.write(f"{pair[0]} {pair[1]} {list_issues} \n")
-            file.close()
-
-        for dirpath, _, filenames in os.walk(ctp_subject_folder):
-            print(f"> Clean {dirpath}")
-            for filename in filenames:
-                ctp_file_path = join(dirpath, filename)
-                ctp_file_image = pydicom.dcmread(ctp_file_path)
-                ctp_dicom_corrected = ctp_file_image  # not necessary, just for clarity
-
-                for dangerous_tag in dangerous_tag_pairs:
-                    ctp_dicom_corrected = anonymize_tag_recurse(
-                        ctp_dicom_corrected, dangerous_tag[0], dangerous_tag[1]
-                    )
-
-                ctp_dicom_corrected.save_as(ctp_file_path)  # No turning back
+                file.writelines(issues_log)
     print("Done!")
 
 
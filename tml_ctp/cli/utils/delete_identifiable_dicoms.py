@@ -9,139 +9,248 @@
 """Delete DICOM files that could lead to identifying the patient."""
 
 import argparse
+import functools
 import os
 import re
+import shutil
 import warnings
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from glob import iglob
 import pydicom
 from tqdm import tqdm
 
 
 IMAGETYPES_TO_REMOVE = ["SCREEN SAVE", "DISPLAY", "LOCALIZER", "OTHER"]
+IMAGETYPES_TO_REMOVE_SET = frozenset(IMAGETYPES_TO_REMOVE)
 T1W_TO_REMOVE = ["tfl3d", "fl2d"]
+# Case-insensitive patterns, compiled once, of the ProtocolName and SeriesDescription to remove
+PROTOCOLNAMES_TO_REMOVE_RE = re.compile("Scout|localizer", re.IGNORECASE)
+SERIESDESCRIPTIONS_TO_REMOVE_RE = re.compile(
+    "morpho|DEV"
+    "|report"
+    "|AAhead"
+    "|rapid"  # RAPID results
+    "|KEY_IMAGES",  # Key images - potentially annotated
+    # "|tof"
+    re.IGNORECASE,
+)
 
 
-def delete_identifiable_dicom_file(
-    filename: str, delete_T1w: bool = False, delete_T2w: bool = False
-) -> bool:
-    """If identifiable data is present, deletes the Dicom file.
+# Header elements defined at the series level, which are the same for all the files of a series
+SERIES_LEVEL_TAGS = ["Modality", "ProtocolName", "SeriesDescription"]
+# Header elements that can differ between the files of a series
+INSTANCE_LEVEL_TAGS = ["Modality", "ImageType", "SequenceName"]
+
+
+def read_dicom_header(filename: str, tags: list) -> pydicom.Dataset:
+    """Read only the given header elements of a Dicom file, skipping the rest of the header and the pixel data.
 
     Args:
         filename (str): path to dicom image.
-        delete_T1w (bool): also delete potentially identifiable (face-reconstructible) T1w images like MPRAGEs
-        delete_T2w (bool): also delete potentially identifiable (face-reconstructible) T2w images like FLAIRs
+        tags (list): keywords of the header elements to read.
 
     Returns:
-        bool: whether the file was deleted (True) or not (False)
-
-    TODO:
-        - Implement proper exception handling
+        pydicom.Dataset: dataset with the header elements found in the file.
     """
-
-    # Load the current dicom file to depersonalise
     try:
-        dataset = pydicom.read_file(filename)
+        return pydicom.dcmread(filename, stop_before_pixels=True, specific_tags=tags)
     except pydicom.errors.InvalidDicomError:
         print("Dicom reading error at file at path :  " + filename)
         raise
 
-    delete_this_file = False
-
-    # parse DICOM header
-    attributes = dataset.dir("")
-    if "Modality" in attributes:
-        if "SR" in dataset.data_element("Modality").value:
-            delete_this_file = True
-
-    if not delete_this_file and ("ImageType" in attributes):
-        if any(
-            [
-                this_type in dataset.data_element("ImageType").value
-                for this_type in IMAGETYPES_TO_REMOVE
-            ]
-        ):
-            delete_this_file = True
-        if (
-            "SECONDARY" in dataset.data_element("ImageType").value
-            and "CT" in dataset.data_element("Modality").value
-        ):
-            delete_this_file = True
-
-    if not delete_this_file and ("ProtocolName" in attributes):
-        my_re_pn = re.compile("(?i).*(Scout|localizer).*")
-        if my_re_pn.search(dataset.data_element("ProtocolName").value) is not None:
-            delete_this_file = True
-
-    if not delete_this_file and ("SeriesDescription" in attributes):
-        my_re_sd_morpho = re.compile("(?i).*(morpho|DEV).*")
-        if (
-            my_re_sd_morpho.search(dataset.data_element("SeriesDescription").value)
-            is not None
-        ):
-            delete_this_file = True
-        # my_re_sd_tof=re.compile('(?i).*tof.*')
-        # if my_re_sd_tof.search(dataset.data_element('SeriesDescription').value) is not None:
-        #    delete_this_file = True
-        my_re_sd_report = re.compile("(?i).*report.*")
-        if (
-            my_re_sd_report.search(dataset.data_element("SeriesDescription").value)
-            is not None
-        ):
-            delete_this_file = True
-        my_re_sd_AAH = re.compile("(?i).*AAhead.*")
-        if (
-            my_re_sd_AAH.search(dataset.data_element("SeriesDescription").value)
-            is not None
-        ):
-            delete_this_file = True
-        my_re_sd_rapid = re.compile("(?i).*rapid.*")  # RAPID results
-        if (
-            my_re_sd_rapid.search(dataset.data_element("SeriesDescription").value)
-            is not None
-        ):
-            delete_this_file = True
-        my_re_sd_Key = re.compile(
-            "(?i).*KEY_IMAGES.*"
-        )  # Key images - potentially annotated
-        if (
-            my_re_sd_Key.search(dataset.data_element("SeriesDescription").value)
-            is not None
-        ):
-            delete_this_file = True
-
-    if not delete_this_file and delete_T1w:
+
+def is_identifiable_series(dataset: pydicom.Dataset) -> bool:
+    """Check the series-level header elements (Modality, ProtocolName, SeriesDescription) of a Dicom file.
+
+    Args:
+        dataset (pydicom.Dataset): dataset with at least the header elements in SERIES_LEVEL_TAGS.
+
+    Returns:
+        bool: whether the series of the file could lead to identifying the patient
+    """
+    modality = dataset.get("Modality")
+    protocol_name = dataset.get("ProtocolName")
+    series_description = dataset.get("SeriesDescription")
+
+    if modality is not None and "SR" in modality:
+        return True
+
+    if protocol_name is not None:
+        if PROTOCOLNAMES_TO_REMOVE_RE.search(protocol_name) is not None:
+            return True
+
+    if series_description is not None:
+        if SERIESDESCRIPTIONS_TO_REMOVE_RE.search(series_description) is not None:
+            return True
+
+    return False
+
+
+def is_identifiable_instance(
+    dataset: pydicom.Dataset, delete_T1w: bool = False, delete_T2w: bool = False
+) -> bool:
+    """Check the instance-level header elements (Modality, ImageType, SequenceName) of a Dicom file.
+
+    Args:
+        dataset (pydicom.Dataset): dataset with at least the header elements in INSTANCE_LEVEL_TAGS.
+        delete_T1w (bool): also flag potentially identifiable (face-reconstructible) T1w images like MPRAGEs
+        delete_T2w (bool): also flag potentially identifiable (face-reconstructible) T2w images like FLAIRs
+
+    Returns:
+        bool: whether the file could lead to identifying the patient
+    """
+    modality = dataset.get("Modality")
+    image_type = dataset.get("ImageType")
+    sequence_name = dataset.get("SequenceName")
+
+    if image_type is None:
+        return False
+
+    # ImageType is usually multi-valued, but can be a single string
+    if isinstance(image_type, str):
+        image_types = {image_type}
+    else:
+        image_types = set(image_type)
+
+    if not IMAGETYPES_TO_REMOVE_SET.isdisjoint(image_types):
+        return True
+    if "SECONDARY" in image_types and modality is not None and "CT" in modality:
+        return True
+
+    if delete_T1w:
         # Sagittal 2D FLASH (Vida): SequenceName *fl2d1, ScanningSequence: GR, ImageType ORIGINAL\PRIMARY
         # mprage: ImageType ORIGINAL\PRIMARY, sequenceName tfl3d
-        if ("SequenceName" in attributes) and ("ImageType" in attributes):
+        if sequence_name is not None:
             if any(
-                [
-                    this_seqname in dataset.data_element("SequenceName").value
-                    for this_seqname in T1W_TO_REMOVE
-                ]
-            ) and "ORIGINAL" in dataset.data_element("ImageType"):
-                delete_this_file = True
+                [this_seqname in sequence_name for this_seqname in T1W_TO_REMOVE]
+            ) and "ORIGINAL" in image_types:
+                return True
 
-    if not delete_this_file and delete_T2w:
+    if delete_T2w:
         # Transverse 2D FLAIR (turbo inversion recovery): SequenceName *tir2d1_15, ScanningSequence: SE, MRAcquisitionType: 2D, ImageType ORIGINAL\PRIMARY
         # Other FLAIR: SequenceName: spcir, MRAcquisitionType: 3D
         # -> SequenceName: .*'?IR'?.* not case sensitive
-        if ("SequenceName" in attributes) and ("ImageType" in attributes):
-            if "ir" in dataset.data_element(
-                "SequenceName"
-            ).value and "ORIGINAL" in dataset.data_element("ImageType"):
-                delete_this_file = True
+        if sequence_name is not None:
+            if "ir" in sequence_name and "ORIGINAL" in image_types:
+                return True
+
+    return False
+
+
+def delete_identifiable_dicom_file(
+    filename: str,
+    delete_T1w: bool = False,
+    delete_T2w: bool = False,
+    check_series_level: bool = True,
+    dry_run: bool = False,
+) -> bool:
+    """If identifiable data is present, deletes the Dicom file.
+
+    Args:
+        filename (str): path to dicom image.
+        delete_T1w (bool): also delete potentially identifiable (face-reconstructible) T1w images like MPRAGEs
+        delete_T2w (bool): also delete potentially identifiable (face-reconstructible) T2w images like FLAIRs
+        check_series_level (bool): also check the series-level header elements, which can be skipped
+                                   when the series has already been checked
+        dry_run (bool): only check the file, without deleting it
+
+    Returns:
+        bool: whether the file was deleted (True) or not (False), or would be deleted if dry_run is True
+
+    TODO:
+        - Implement proper exception handling
+    """
+
+    # Load the header elements used to decide whether the file should be deleted
+    if check_series_level:
+        # Modality is in both lists
+        dataset = read_dicom_header(
+            filename, SERIES_LEVEL_TAGS + INSTANCE_LEVEL_TAGS[1:]
+        )
+        delete_this_file = is_identifiable_series(dataset) or is_identifiable_instance(
+            dataset, delete_T1w, delete_T2w
+        )
+    else:
+        dataset = read_dicom_header(filename, INSTANCE_LEVEL_TAGS)
+        delete_this_file = is_identifiable_instance(dataset, delete_T1w, delete_T2w)
 
-    if delete_this_file:
+    if delete_this_file and not dry_run:
         os.remove(filename)
 
     return delete_this_file
 
 
+def delete_identifiable_dicom_series(filenames: list, dry_run: bool = False) -> int:
+    """If the series-level header elements of the first Dicom file of a series are identifiable, deletes all the files of the series.
+
+    The series-level header elements screened by :func:`is_identifiable_series` (Modality,
+    ProtocolName, SeriesDescription) are the same for all the files of a series, so only the
+    first file is read. The instance-level header elements (ImageType, SequenceName) can differ
+    between the files and are not checked here. If the series folder contains nothing else
+    than the files of the series, the whole folder is removed at once with :func:`shutil.rmtree`.
+
+    Args:
+        filenames (list): paths to the dicom images of the series, all in the same folder.
+        dry_run (bool): only check the series, without deleting any file
+
+    Returns:
+        int: number of deleted files, or of files that would be deleted if dry_run is True
+    """
+    if not filenames:
+        return 0
+
+    if not is_identifiable_series(read_dicom_header(filenames[0], SERIES_LEVEL_TAGS)):
+        return 0
+
+    if dry_run:
+        return len(filenames)
+
+    series_dir = os.path.dirname(filenames[0])
+    if len(os.listdir(series_dir)) == len(filenames):
+        # Only the files of the series are in the folder
+        shutil.rmtree(series_dir)
+    else:
+        for filename in filenames:
+            os.remove(filename)
+
+    return len(filenames)
+
+
+def iter_series_files(patient_folder: str):
+    """Yield the files of each series of a patient, listed with :func:`os.scandir`.
+
+    The patient folder is expected to contain study folders, each containing series folders.
+    Hidden files are ignored, as with ``glob``.
+
+    Args:
+        patient_folder (str): Path to the folder of the patient.
+
+    Yields:
+        tuple: Name of the series folder and list of the paths to its files.
+    """
+    with os.scandir(patient_folder) as it:
+        study_dirs = [entry.path for entry in it if entry.is_dir()]
+    for study_dir in study_dirs:
+        with os.scandir(study_dir) as it:
+            series_dirs = [entry for entry in it if entry.is_dir()]
+        for series_dir in series_dirs:
+            with os.scandir(series_dir.path) as it:
+                filenames = [
+                    entry.path
+                    for entry in it
+                    if not entry.name.startswith(".") and entry.is_file()
+                ]
+            yield series_dir.name, filenames
+
+
 def sanitize_all_dicoms_within_root_folder(
     datapath: str,
     pattern_dicom_files: str = os.path.join("ses-*", "*", "*"),
     delete_T1w: bool = False,
     delete_T2w: bool = False,
+    max_workers: int = None,
+    executor_type: str = "process",
+    dry_run: bool = False,
 ) -> int:
     """
     Sanitizes all Dicom images located at the datapath in the structure specified by pattern_dicom_files parameter.
@@ -152,13 +261,21 @@ def sanitize_all_dicoms_within_root_folder(
                                    In a PACSMAN dump, this would reflect e.g. ``ses-20170115/0002-MPRAGE/*.dcm``.
         delete_T1w (bool): Delete T1-weighted images that could be used to identify the patients.
         delete_T2w (bool): Delete T2-weighted images that could be used to identify the patients.
+        max_workers (int): Number of workers in which the files are checked (default: the number of CPUs).
+        executor_type (str): Type of workers in which the files are checked, ``"process"`` or ``"thread"``.
+                             Threads avoid the cost of starting processes, e.g. on network filesystems.
+        dry_run (bool): Only report the files that would be deleted, without deleting them.
 
     Returns:
         int: Always 0.
+
+    Raises:
+        ValueError: If executor_type is neither ``"process"`` nor ``"thread"``.
     """
 
     # List all  patient directories.
-    patients_folders = next(os.walk(datapath))[1]
+    with os.scandir(datapath) as it:
+        patients_folders = [entry.name for entry in it if entry.is_dir()]
 
     if not patients_folders:
         raise NotADirectoryError(
@@ -166,56 +283,88 @@ def sanitize_all_dicoms_within_root_folder(
             + datapath
         )
 
-    # Loop over patients...
-    for _, patient in enumerate(tqdm(patients_folders)):
-        print(f"processing {patient}")
-        current_path = os.path.join(datapath, patient, pattern_dicom_files)
-
-        # List all files within patient folder
-        all_filenames = glob(current_path)
-
-        if not all_filenames:
-            warnings.warn(
-                "Problem reading data for patient "
-                + patient
-                + " at "
-                + current_path
-                + "."
-            )
-            warnings.warn(
-                "Patient directories are expect to conform to the pattern set "
-                "in pattern_dicom_files, currently " + pattern_dicom_files
-            )
-        else:
-            # List all study dirs for this patient.
-            study_dirs = next(os.walk(os.path.join(datapath, patient)))[1]
-
-            for study_dir in study_dirs:
-                # List all series dirs for this patient.
-                series_dirs = next(os.walk(os.path.join(datapath, patient, study_dir)))[
-                    1
+    if executor_type == "thread":
+        Executor = ThreadPoolExecutor
+    elif executor_type == "process":
+        Executor = ProcessPoolExecutor
+    else:
+        raise ValueError(
+            f"executor_type should be 'thread' or 'process', got '{executor_type}'"
+        )
+
+    # The files are checked in parallel, in a pool shared by all the patients
+    with Executor(max_workers=max_workers) as executor:
+        # Loop over patients...
+        for _, patient in enumerate(tqdm(patients_folders)):
+            print(f"processing {patient}")
+            current_path = os.path.join(datapath, patient, pattern_dicom_files)
+
+            # Check that the patient folder contains files matching the pattern,
+            # stopping at the first one instead of listing them all
+            if next(iglob(current_path), None) is None:
+                warnings.warn(
+                    "Problem reading data for patient "
+                    + patient
+                    + " at "
+                    + current_path
+                    + "."
+                )
+                warnings.warn(
+                    "Patient directories are expect to conform to the pattern set "
+                    "in pattern_dicom_files, currently " + pattern_dicom_files
+                )
+            else:
+                series = list(iter_series_files(os.path.join(datapath, patient)))
+
+                all_filenames_per_series = [
+                    all_filenames_series for _, all_filenames_series in series
                 ]
 
-                # Loop over this patient's series one by one
-                for series_dir in series_dirs:
-                    all_filenames_series = glob(
-                        os.path.join(datapath, patient, study_dir, series_dir, "*")
+                # The series-level header elements are the same for all the files of a series,
+                # so they are checked once per series, and flagged series are deleted as a whole
+                n_deleted_files_per_flagged_series = list(
+                    executor.map(
+                        functools.partial(
+                            delete_identifiable_dicom_series, dry_run=dry_run
+                        ),
+                        all_filenames_per_series,
                     )
-
-                    # Loop over all dicom files within a series and remove offending files
-                    n_deleted_files_in_series = 0
-                    for filename in all_filenames_series:
-                        # TODO speedup - if we flag one file, we can assume the whole series can be deleted and we can
-                        #  just delete the rest of the dir
-                        file_deleted = delete_identifiable_dicom_file(
-                            filename, delete_T1w, delete_T2w
+                )
+                # The instance-level header elements can differ between the files of a series,
+                # so they are checked for all dicom files within the other series in parallel,
+                # and offending files are removed
+                check_instance = functools.partial(
+                    delete_identifiable_dicom_file,
+                    delete_T1w=delete_T1w,
+                    delete_T2w=delete_T2w,
+                    check_series_level=False,
+                    dry_run=dry_run,
+                )
+                # executor.map submits all the files at once, so the checks of all the
+                # series are submitted before any result is collected
+                results_per_series = []
+                for all_filenames_series, n_deleted_files_in_series in zip(
+                    all_filenames_per_series, n_deleted_files_per_flagged_series
+                ):
+                    if n_deleted_files_in_series > 0:
+                        results_per_series.append([n_deleted_files_in_series])
+                    else:
+                        results_per_series.append(
+                            executor.map(
+                                check_instance, all_filenames_series, chunksize=16
+                            )
                         )
-                        if file_deleted:
-                            n_deleted_files_in_series += 1
+                n_deleted_files_per_series = [
+                    sum(results) for results in results_per_series
+                ]
 
+                for (series_dir, _), n_deleted_files_in_series in zip(
+                    series, n_deleted_files_per_series
+                ):
                     if n_deleted_files_in_series > 0:
                         print(
-                            f"Deleted {n_deleted_files_in_series} files from series {series_dir}"
+                            f"{'Would delete' if dry_run else 'Deleted'} "
+                            f"{n_deleted_files_in_series} files from series {series_dir}"
                         )
     return 0
 
@@ -247,6 +396,26 @@ def get_parser():
         required=False,
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of DICOM files or series to check in parallel (default: the number of CPUs).",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=["process", "thread"],
+        default="process",
+        help="Check the DICOM files in worker processes or threads (default: process)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        help="Only report the DICOM files that would be deleted, without deleting them (e.g. to profile the checks)",
+        default=False,
+        required=False,
+        action="store_true",
+    )
     return parser
 
 
@@ -256,6 +425,10 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
 
+    # Check that at least one file or series is checked at a time
+    if args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
+
     data_path = os.path.normcase(os.path.abspath(args.in_folder))
     delete_T1w = args.delete_T1w
     delete_T2w = args.delete_T2w
@@ -270,7 +443,12 @@ def main():
     )
     # Sanitize all files.
     _ = sanitize_all_dicoms_within_root_folder(
-        datapath=data_path, delete_T1w=delete_T1w, delete_T2w=delete_T2w
+        datapath=data_path,
+        delete_T1w=delete_T1w,
+        delete_T2w=delete_T2w,
+        max_workers=args.jobs,
+        executor_type=args.executor,
+        dry_run=args.dry_run,
     )
 
 